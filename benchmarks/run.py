@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Measure what pylogtrace costs.
+
+Every workload in workloads/ is run in a fresh interpreter, once untraced
+and once under each tracing mode, and the results are written as JSON:
+
+    $ python3 benchmarks/run.py -o before.json
+    $ python3 benchmarks/run.py --tracer /path/to/new/pylogtrace.py \\
+          -o after.json --compare before.json
+
+The count modes save their counts to a temporary file and write no
+.cover reports, so the cost of the reports is not measured.
+
+For every workload and mode the file holds the best wall time of the
+repeats, the slowdown against the untraced run, the number of rounds
+printed and rounds per second, and the peak RSS of the traced process
+(ru_maxrss from os.wait4()).
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKLOADS_DIR = os.path.join(HERE, 'workloads')
+DEFAULT_TRACER = os.path.join(os.path.dirname(HERE), 'pylogtrace.py')
+
+# name -> pylogtrace arguments; None runs the workload untraced.
+MODES = {
+    'untraced': None,
+    'trace': ['--trace'],
+    'trace-g': ['--trace', '-g'],
+    'count': ['--count'],
+    'count-g': ['--count', '-g'],
+    'listfuncs': ['--listfuncs'],
+    'trackcalls': ['--trackcalls'],
+}
+
+# The first frame of every round is printed as " #1 [ NEW ]  file" or
+# " #1 [ EQU ]  file"; the "== Previous" summary line is not a round.
+_ROUND_RE = re.compile(rb'^(?:\x1b\[[0-9;]*m)*\s*#1 \[ (?:NEW|EQU) \] (?!=)')
+
+
+def workload_names():
+    return sorted(name[:-3] for name in os.listdir(WORKLOADS_DIR)
+                  if name.endswith('.py') and not name.startswith('_'))
+
+
+def _count_rounds(stream, result):
+    rounds = 0
+    nbytes = 0
+    for line in stream:
+        nbytes += len(line)
+        if _ROUND_RE.match(line):
+            rounds += 1
+    result['rounds'] = rounds
+    result['output_bytes'] = nbytes
+
+
+def run_once(python, tracer, mode_args, workload, size, timeout):
+    """Run one workload once; return wall time, rounds and peak RSS."""
+    with tempfile.TemporaryDirectory(prefix='pylogtrace-bench-') as tmp:
+        # The workload and the tracer run from copies in tmp, so that
+        # nothing a run writes next to them lands in the checkout.
+        script = shutil.copy(os.path.join(WORKLOADS_DIR, workload + '.py'),
+                             tmp)
+        if mode_args is None:
+            cmd = [python, script]
+        else:
+            if '--count' in mode_args:
+                # No .cover reports: the ones of the stdlib and
+                # site-packages modules would be written next to them,
+                # in the interpreter's tree, whatever --coverdir says.
+                # The counts are still saved, to a file in tmp.
+                mode_args = mode_args + ['--no-report', '--file',
+                                         os.path.join(tmp, 'counts')]
+            cmd = [python, shutil.copy(tracer, tmp)] + mode_args + [script]
+        if size is not None:
+            cmd.append(str(size))
+        counted = {}
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=tmp, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        reader = threading.Thread(target=_count_rounds,
+                                  args=(proc.stdout, counted))
+        reader.start()
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)
+        finally:
+            timer.cancel()
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        reader.join()
+        proc.stdout.close()
+    if proc.returncode != 0:
+        raise RuntimeError('%s exited with %d' % (' '.join(cmd),
+                                                  proc.returncode))
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    maxrss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return {'wall': wall, 'rounds': counted['rounds'],
+            'output_bytes': counted['output_bytes'], 'max_rss_kb': maxrss}
+
+
+def run_benchmarks(python, tracer, workloads, modes, repeat, size, timeout,
+                   progress=None):
+    results = {}
+    for workload in workloads:
+        per_mode = results[workload] = {}
+        for mode in modes:
+            runs = [run_once(python, tracer, MODES[mode], workload, size,
+                             timeout)
+                    for _ in range(repeat)]
+            best = min(runs, key=lambda run: run['wall'])
+            entry = {
+                'wall': best['wall'],
+                'walls': [run['wall'] for run in runs],
+                'rounds': best['rounds'],
+                'output_bytes': best['output_bytes'],
+                'max_rss_kb': max(run['max_rss_kb'] for run in runs),
+            }
+            entry['rounds_per_sec'] = (entry['rounds'] / entry['wall']
+                                       if entry['wall'] else 0.0)
+            per_mode[mode] = entry
+            if progress:
+                progress(workload, mode, entry)
+        base = per_mode.get('untraced')
+        for mode, entry in per_mode.items():
+            entry['slowdown'] = (entry['wall'] / base['wall']
+                                 if base and base['wall'] else None)
+    return results
+
+
+def _git_revision(path):
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=os.path.dirname(path), capture_output=True,
+                             text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def _python_version(python):
+    out = subprocess.run([python, '-c', 'import sys; print(sys.version)'],
+                         capture_output=True, text=True, check=True)
+    return out.stdout.strip()
+
+
+def compare(old, new):
+    """Print the slowdown of each run in *new* next to the one in *old*."""
+    print('%-16s %-11s %9s %9s %8s %9s %9s' % (
+        'workload', 'mode', 'old', 'new', 'change', 'old RSS', 'new RSS'))
+    for workload, modes in sorted(new['results'].items()):
+        for mode, entry in modes.items():
+            before = old['results'].get(workload, {}).get(mode)
+            if before is None or mode == 'untraced':
+                continue
+            if entry['slowdown'] and before['slowdown']:
+                change = '%+7.1f%%' % (
+                    (entry['slowdown'] / before['slowdown'] - 1) * 100)
+            else:
+                change = '-'
+            print('%-16s %-11s %8.2fx %8.2fx %8s %7dkB %7dkB' % (
+                workload, mode, before['slowdown'] or 0,
+                entry['slowdown'] or 0, change, before['max_rss_kb'],
+                entry['max_rss_kb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure pylogtrace overhead per mode.')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run workloads with '
+                             '(default: this one)')
+    parser.add_argument('--tracer', default=DEFAULT_TRACER,
+                        help='pylogtrace.py to measure '
+                             '(default: the one in this checkout)')
+    parser.add_argument('-w', '--workload', action='append',
+                        choices=workload_names(),
+                        help='workload to run (repeatable; default: all)')
+    parser.add_argument('-m', '--mode', action='append', choices=list(MODES),
+                        help='mode to run (repeatable; default: all)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='runs per workload and mode; the fastest one '
+                             'is reported (default: 3)')
+    parser.add_argument('--size', type=int,
+                        help='override the size argument of every workload')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='kill a run after this many seconds')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with an earlier JSON file')
+    opts = parser.parse_args(argv)
+
+    workloads = opts.workload or workload_names()
+    modes = opts.mode or list(MODES)
+    if 'untraced' not in modes:
+        # Slowdowns need a baseline.
+        modes.insert(0, 'untraced')
+    tracer = os.path.abspath(opts.tracer)
+
+    def progress(workload, mode, entry):
+        print('%-16s %-11s %8.3fs %6d rounds %8dkB' % (
+            workload, mode, entry['wall'], entry['rounds'],
+            entry['max_rss_kb']), file=sys.stderr)
+
+    results = run_benchmarks(opts.python, tracer, workloads, modes,
+                             opts.repeat, opts.size, opts.timeout, progress)
+    report = {
+        'meta': {
+            'tracer': tracer,
+            'revision': _git_revision(tracer),
+            'python': _python_version(opts.python),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'repeat': opts.repeat,
+            'size': opts.size,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
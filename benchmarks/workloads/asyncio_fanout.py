@@ -0,0 +1,21 @@
+"""asyncio fan-out: many tasks interleaving output at await points."""
+import asyncio
+import sys
+
+
+async def worker(i, steps):
+    for step in range(steps):
+        await asyncio.sleep(0)
+        print('worker', i, 'step', step)
+
+
+async def fanout(n):
+    await asyncio.gather(*(worker(i, 5) for i in range(n)))
+
+
+def main(n):
+    asyncio.run(fanout(n))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,23 @@
+"""Import-heavy startup: lots of module-level code and little output."""
+import sys
+
+MODULES = [
+    'argparse', 'ast', 'asyncio', 'calendar', 'csv', 'dataclasses',
+    'decimal', 'difflib', 'email.message', 'email.parser', 'fractions',
+    'ftplib', 'http.client', 'http.server', 'inspect', 'ipaddress', 'json',
+    'logging.handlers', 'mailbox', 'pathlib', 'pickletools', 'pydoc',
+    'sqlite3', 'statistics', 'string', 'tarfile', 'textwrap', 'typing',
+    'unittest', 'urllib.request', 'uuid', 'xml.dom.minidom',
+    'xml.etree.ElementTree', 'zipfile',
+]
+
+
+def main(n):
+    import importlib
+    for name in MODULES[:n]:
+        importlib.import_module(name)
+    print('imported', len(sys.modules), 'modules')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else len(MODULES))
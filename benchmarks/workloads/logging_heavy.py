@@ -0,0 +1,23 @@
+"""logging-heavy code: every round goes through the logging machinery."""
+import logging
+import sys
+
+log = logging.getLogger('bench')
+
+
+def work(i):
+    log.debug('skipped %d', i)
+    log.info('item %d', i)
+    if i % 10 == 0:
+        log.warning('checkpoint %d', i)
+
+
+def main(n):
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    for i in range(n):
+        work(i)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,16 @@
+"""print()-heavy loop: many rounds from a couple of shallow call sites."""
+import sys
+
+
+def emit(i):
+    print('line', i)
+    sys.stdout.write('write %d\n' % i)
+
+
+def main(n):
+    for i in range(n):
+        emit(i)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,23 @@
+"""Deep recursion: large stacks per round and many untraced calls."""
+import sys
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def descend(depth):
+    if depth == 0:
+        print('bottom', fib(12))
+        return 0
+    return descend(depth - 1) + 1
+
+
+def main(n):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 1000))
+    for _ in range(n):
+        descend(200)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
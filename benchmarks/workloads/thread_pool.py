@@ -0,0 +1,19 @@
+"""Thread pool: output from several threads at once."""
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def task(i):
+    total = sum(range(200))
+    print('task', i, total)
+    return total
+
+
+def main(n):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for _ in pool.map(task, range(n)):
+            pass
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -47,25 +47,44 @@ Sample use, programmatically
   r = tracer.results()
   r.write_results(show_missing=True, coverdir="/tmp")
 """
-__all__ = ['Trace', 'CoverageResults']
+__all__ = ['Trace', 'CoverageResults', 'StackDiff', 'StackTrie',
+           'SiteBudget', 'OutputFilter', 'replay_rounds']
 
+import builtins
+import io
+from array import array
 import linecache
+import mmap
 import os
 import sys
 import sysconfig
 import token
 import tokenize
 import inspect
-import gc
 import dis
+import ast
 import pickle
+import hashlib
+import heapq
+import json
+import queue
+import shutil
+import sqlite3
+import tempfile
+import struct
+import time
 from time import monotonic as _time
+from time import perf_counter as _perf_counter
 
 import threading
+import weakref
+import atexit
+import functools
+from collections import OrderedDict
 
 #hole:
-import copy, re, logging, traceback
-from termcolor import cprint
+import re, logging, traceback
+from termcolor import colored
 import colorama
 from colorama import Style, Fore, Back
 colorama.init() # Windows need this
@@ -73,55 +92,128 @@ BOLD_ONLY = ['bold']
 
 PRAGMA_NOCOVER = "#pragma NO COVER"
 
+_ModuleType = type(sys)
+
+# sys.monitoring (PEP 669) is only available on Python 3.12+
+_HAVE_MONITORING = hasattr(sys, 'monitoring')
+# Python 3.12+ can set the hooks of threads that are already running
+_HAVE_ALL_THREADS = hasattr(threading, 'settrace_all_threads')
+
 class _Ignore:
+    """The --ignore-module and --ignore-dir rules.
+
+    The rules are compiled into one regular expression over module names
+    and one over filenames, and the answer for each module name is
+    cached.  Both kinds of rule may be glob patterns: in module names
+    '*' and '?' match any characters, in directories they stay within
+    one path component and '**' matches any number of components.
+    """
+
     def __init__(self, modules=None, dirs=None):
         self._mods = set() if not modules else set(modules)
         self._dirs = [] if not dirs else [os.path.normpath(d)
                                           for d in dirs]
         self._ignore = { '<string>': 1 }
+        self.stats = None   # a _TraceStats, see Trace
+        # Need to take some care since ignoring "cmp" mustn't mean
+        # ignoring "cmpcache" but ignoring "Spam" must also mean
+        # ignoring "Spam.Eggs".
+        self._mods_re = _compile_rules(
+            [_glob_to_regex(mod, '.') + r'(?:\..*)?\Z'
+             for mod in sorted(self._mods)])
+        # The os.sep is to ensure that d is a parent directory, as
+        # compared to cases like d = "/usr/local" and filename =
+        # "/usr/local.py"
+        seps = re.escape(os.sep + (os.altsep or ''))
+        self._dirs_re = _compile_rules(
+            [_glob_to_regex(d, '[^%s]' % seps) + re.escape(os.sep)
+             for d in self._dirs])
 
     def names(self, filename, modulename):
-        if modulename in self._ignore:
+        try:
             return self._ignore[modulename]
+        except KeyError:
+            pass
 
         # haven't seen this one before, so see if the module name is
-        # on the ignore list.
-        if modulename in self._mods:  # Identical names, so ignore
-            self._ignore[modulename] = 1
-            return 1
-
-        # check if the module is a proper submodule of something on
-        # the ignore list
-        for mod in self._mods:
-            # Need to take some care since ignoring
-            # "cmp" mustn't mean ignoring "cmpcache" but ignoring
-            # "Spam" must also mean ignoring "Spam.Eggs".
-            if modulename.startswith(mod + '.'):
-                self._ignore[modulename] = 1
-                return 1
-
-        # Now check that filename isn't in one of the directories
-        if filename is None:
-            # must be a built-in, so we must ignore
-            self._ignore[modulename] = 1
-            return 1
-
-        # Ignore a file when it contains one of the ignorable paths
-        for d in self._dirs:
-            # The '+ os.sep' is to ensure that d is a parent directory,
-            # as compared to cases like:
-            #  d = "/usr/local"
-            #  filename = "/usr/local.py"
-            # or
-            #  d = "/usr/local.py"
-            #  filename = "/usr/local.py"
-            if filename.startswith(d + os.sep):
-                self._ignore[modulename] = 1
-                return 1
-
-        # Tried the different ways, so we don't ignore this module
-        self._ignore[modulename] = 0
-        return 0
+        # on the ignore list, or else if it is a built-in (no filename)
+        # or a file in one of the directories
+        if self.stats is not None:
+            self.stats.count('ignore regex checks')
+        if self._mods_re is not None and self._mods_re.match(modulename):
+            ignore = 1
+        elif filename is None:
+            ignore = 1
+        elif self._dirs_re is not None and self._dirs_re.match(filename):
+            ignore = 1
+        else:
+            ignore = 0
+        self._ignore[modulename] = ignore
+        return ignore
+
+def _compile_rules(patterns):
+    """Compile regexes into one that matches where any of them does."""
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % p for p in patterns), re.DOTALL)
+
+def _glob_to_regex(pattern, any_char):
+    """Translate a glob pattern into a regex; any_char is the regex
+    that '?' stands for, '*' being any number of those and '**' any
+    number of any character."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern.startswith('*', i):
+                i += 1
+                out.append('.*')
+            else:
+                out.append(any_char + '*')
+        elif c == '?':
+            out.append(any_char)
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i:j].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[%s]' % body)
+                i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+class _SinkStream:
+    """Stand-in for sys.stdout/sys.stderr used by the output-sink backend.
+
+    Every attribute but write() and writelines() is the wrapped stream's.
+    """
+
+    def __init__(self, stream, sink_call):
+        self._stream = stream
+        self._sink_call = sink_call
+
+    def write(self, s):
+        return self._sink_call(sys._getframe(1), self._stream.write, (s,), {},
+                               'write')
+
+    def writelines(self, lines):
+        # A list, so that an output filter can read the lines too
+        return self._sink_call(sys._getframe(1), self._stream.writelines,
+                               (list(lines),), {}, 'writelines')
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
 
 def _modname(path):
     """Return a plausible module name for the patch."""
@@ -166,6 +258,121 @@ def _fullmodname(path):
     return filename.lstrip(".")
     '''
 
+# Counts files (-f/--file) are SQLite databases, so that runs can add to
+# one file at the same time and reports read it one source file at a
+# time.  Files names are stored once; calledfuncs and callers keys are
+# stored as JSON arrays.  Old pickled counts files are still read.
+_STORE_MAGIC = b'SQLite format 3\x00'
+_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY,
+                                  name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS lines (file INTEGER NOT NULL,
+                                  lineno INTEGER NOT NULL,
+                                  count INTEGER NOT NULL,
+                                  PRIMARY KEY (file, lineno)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS funcs (key TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS callers (key TEXT PRIMARY KEY) WITHOUT ROWID;
+"""
+_UPSERT_LINE = """
+INSERT INTO lines (file, lineno, count) VALUES (?, ?, ?)
+ON CONFLICT (file, lineno) DO UPDATE SET count = count + excluded.count
+"""
+
+class _CountsStore:
+    """A counts file: SQLite in WAL mode, written in BEGIN IMMEDIATE
+    transactions that add to the counts already there."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_STORE_SCHEMA)
+
+    @staticmethod
+    def file_format(path):
+        """Return 'store' if path is a file in this format, 'empty' if
+        it is missing or empty, else 'other' (an old pickled file).
+
+        Must not be called while this process has the file open in
+        SQLite: closing any other descriptor of a file drops the POSIX
+        locks SQLite holds on it.  An empty file may be one that
+        another process is just creating, so it counts as a store.
+        """
+        try:
+            with open(path, 'rb') as f:
+                head = f.read(len(_STORE_MAGIC))
+        except OSError:
+            return 'empty'
+        if head == _STORE_MAGIC:
+            return 'store'
+        return 'empty' if not head else 'other'
+
+    def close(self):
+        self._db.close()
+
+    def add(self, counts, calledfuncs, callers, merge=None):
+        """Add counts to the stored ones and store the calledfuncs and
+        callers keys, in one transaction.  merge is the path of another
+        counts file whose data is added too, in SQL."""
+        db = self._db
+        if merge is not None:
+            db.execute('ATTACH DATABASE ? AS src', (merge,))
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                names = {filename for filename, _ in counts}
+                db.executemany('INSERT OR IGNORE INTO files (name) VALUES (?)',
+                               [(name,) for name in names])
+                ids = dict(db.execute('SELECT name, id FROM files'))
+                db.executemany(_UPSERT_LINE,
+                               [(ids[filename], lineno, n)
+                                for (filename, lineno), n in counts.items()
+                                if lineno is not None])
+                db.executemany('INSERT OR IGNORE INTO funcs VALUES (?)',
+                               [(json.dumps(key),) for key in calledfuncs])
+                db.executemany('INSERT OR IGNORE INTO callers VALUES (?)',
+                               [(json.dumps(key),) for key in callers])
+                if merge is not None:
+                    db.execute('INSERT OR IGNORE INTO files (name) '
+                               'SELECT name FROM src.files')
+                    db.execute(
+                        'INSERT INTO lines (file, lineno, count) '
+                        'SELECT f.id, l.lineno, l.count FROM src.lines l '
+                        'JOIN src.files s ON s.id = l.file '
+                        'JOIN files f ON f.name = s.name WHERE true '
+                        'ON CONFLICT (file, lineno) '
+                        'DO UPDATE SET count = count + excluded.count')
+                    db.execute('INSERT OR IGNORE INTO funcs '
+                               'SELECT key FROM src.funcs')
+                    db.execute('INSERT OR IGNORE INTO callers '
+                               'SELECT key FROM src.callers')
+                db.execute('COMMIT')
+            except BaseException:
+                if db.in_transaction:
+                    db.execute('ROLLBACK')
+                raise
+        finally:
+            if merge is not None:
+                db.execute('DETACH DATABASE src')
+
+    def filenames(self):
+        return [name for name, in self._db.execute(
+            'SELECT name FROM files WHERE id IN (SELECT file FROM lines)')]
+
+    def file_counts(self, filename):
+        """Return {lineno: count} of one source file."""
+        return dict(self._db.execute(
+            'SELECT lineno, count FROM lines JOIN files ON id = file '
+            'WHERE name = ?', (filename,)))
+
+    def calledfuncs(self):
+        return {tuple(json.loads(key)): 1
+                for key, in self._db.execute('SELECT key FROM funcs')}
+
+    def callers(self):
+        return {tuple(tuple(func) for func in json.loads(key)): 1
+                for key, in self._db.execute('SELECT key FROM callers')}
+
 class CoverageResults:
     def __init__(self, counts=None, calledfuncs=None, infile=None,
                  callers=None, outfile=None):
@@ -183,7 +390,30 @@ class CoverageResults:
         self.callers = self.callers.copy()
         self.infile = infile
         self.outfile = outfile
+        # The counts of a counts file in the SQLite format stay there;
+        # reports read them per source file.
+        self._store = None
+        self._saved = False
+        # The format of the outfile is looked at before any connection
+        # to it is open, see _CountsStore.file_format()
+        self._outfile_format = None
+        if self.outfile:
+            self._outfile_format = _CountsStore.file_format(self.outfile)
+        infile_format = None
         if self.infile:
+            infile_format = (self._outfile_format
+                             if self.infile == self.outfile
+                             else _CountsStore.file_format(self.infile))
+        if infile_format == 'store':
+            try:
+                self._store = _CountsStore(self.infile)
+                self.calledfuncs.update(self._store.calledfuncs())
+                self.callers.update(self._store.callers())
+            except sqlite3.Error as err:
+                self._store = None
+                print(("Skipping counts file %r: %s"
+                                      % (self.infile, err)), file=sys.stderr)
+        elif infile_format == 'other':
             # Try to merge existing counts file.
             try:
                 with open(self.infile, 'rb') as f:
@@ -217,7 +447,8 @@ class CoverageResults:
         for key in other_callers:
             callers[key] = 1
 
-    def write_results(self, show_missing=True, summary=False, coverdir=None):
+    def write_results(self, show_missing=True, summary=False, coverdir=None,
+                      jobs=1, cache_dir=None):
         """
         Write the coverage results.
 
@@ -226,7 +457,16 @@ class CoverageResults:
         :param coverdir: If None, the results of each module are placed in its
                          directory, otherwise it is included in the directory
                          specified.
+        :param jobs: Number of processes writing the .cover files; 0 for one
+                     per CPU.  With more than one, the files are written by
+                     CoverageResults.write_results_file() in worker processes.
+        :param cache_dir: If given, a directory where the executable lines of
+                          each source file are kept between runs, keyed by
+                          path, mtime and size.
         """
+        # The sources may have changed while the program ran
+        _source_lines.checkcache()
+
         if self.calledfuncs:
             print()
             print("functions called:")
@@ -254,12 +494,20 @@ class CoverageResults:
         # turn the counts data ("(filename, lineno) = count") into something
         # accessible on a per-file basis
         per_file = {}
-        for filename, lineno in self.counts:
-            lines_hit = per_file[filename] = per_file.get(filename, {})
-            lines_hit[lineno] = self.counts[(filename, lineno)]
+        if not self._saved:
+            for filename, lineno in self.counts:
+                lines_hit = per_file[filename] = per_file.get(filename, {})
+                lines_hit[lineno] = self.counts[(filename, lineno)]
+        # The counts of a counts file are added per file, when it is
+        # written
+        store = self._store
+        if store is not None:
+            for filename in store.filenames():
+                per_file.setdefault(filename, {})
 
         # accumulate summary info, if needed
         sums = {}
+        reports = []  # (modulename, filename, coverpath, count) per file
 
         for filename, count in per_file.items():
             if self.is_ignored_filename(filename):
@@ -277,18 +525,28 @@ class CoverageResults:
                     os.makedirs(dir)
                 modulename = _fullmodname(filename)
 
-            # If desired, get a list of the line numbers which represent
-            # executable content (returned as a dict for better lookup speed)
-            if show_missing:
-                lnotab = _find_executable_linenos(filename)
-            else:
-                lnotab = {}
-            source = linecache.getlines(filename)
             coverpath = os.path.join(dir, modulename + ".cover")
-            with open(filename, 'rb') as fp:
-                encoding, _ = tokenize.detect_encoding(fp.readline)
-            n_hits, n_lines = self.write_results_file(coverpath, source,
-                                                      lnotab, count, encoding)
+            reports.append((modulename, filename, coverpath, count))
+
+        if jobs != 1 and len(reports) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            workers = jobs or os.cpu_count() or 1
+            n = len(reports)
+            with ProcessPoolExecutor(workers) as pool:
+                written = list(pool.map(
+                    _write_cover_file,
+                    [r[1] for r in reports], [r[2] for r in reports],
+                    [r[3] for r in reports], [show_missing] * n,
+                    [cache_dir] * n, [None] * n,
+                    [store and store.path] * n,
+                    chunksize=max(1, n // (4 * workers))))
+        else:
+            written = [_write_cover_file(filename, coverpath, count,
+                                         show_missing, cache_dir, self, store)
+                       for _, filename, coverpath, count in reports]
+
+        for (modulename, filename, _, _), (n_hits, n_lines) in zip(reports,
+                                                                  written):
             if summary and n_lines:
                 percent = int(100 * n_hits / n_lines)
                 sums[modulename] = n_lines, percent, modulename, filename
@@ -300,14 +558,68 @@ class CoverageResults:
                 n_lines, percent, modulename, filename = sums[m]
                 print("%5d   %3d%%   %s   (%s)" % sums[m])
 
-        if self.outfile:
-            # try and store counts and module info into self.outfile
-            try:
-                with open(self.outfile, 'wb') as f:
-                    pickle.dump((self.counts, self.calledfuncs, self.callers),
-                                f, 1)
-            except OSError as err:
-                print("Can't save counts files because %s" % err, file=sys.stderr)
+        self.save()
+
+    def save(self):
+        """Add the counts and module info to self.outfile, if any.
+
+        Several processes may save to one file at the same time.  The
+        counts are saved once; later calls do nothing.  An old pickled
+        counts file is replaced by one in the new format, holding its
+        counts, which were merged in when it was read.
+        """
+        if not self.outfile or self._saved:
+            return
+        # try and store counts and module info into self.outfile
+        outfile = os.path.abspath(self.outfile)
+        merge = None
+        store = None
+        if self._store is not None:
+            if os.path.abspath(self._store.path) != outfile:
+                merge = self._store.path
+            else:
+                # Already open: a second connection would do, but not
+                # looking at the file with open() again
+                store = self._store
+        if store is None and self._outfile_format is None:
+            # outfile was set after __init__; no connection to it is open
+            self._outfile_format = _CountsStore.file_format(outfile)
+        tmp = None
+        try:
+            if store is None and self._outfile_format == 'other':
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(outfile),
+                                           suffix='.tmp')
+                os.close(fd)
+                os.remove(tmp)
+            if store is not None:
+                store.add(self.counts, self.calledfuncs, self.callers)
+            else:
+                store = _CountsStore(tmp or outfile)
+                try:
+                    store.add(self.counts, self.calledfuncs, self.callers,
+                              merge)
+                finally:
+                    store.close()
+                store = None
+            if tmp:
+                os.replace(tmp, outfile)
+                tmp = None
+        except (OSError, sqlite3.Error) as err:
+            print("Can't save counts files because %s" % err, file=sys.stderr)
+            return
+        finally:
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+        # From now on the counts are read back from the file
+        self._saved = True
+        self._outfile_format = 'store'
+        if store is None:
+            if self._store is not None:
+                self._store.close()
+            self._store = _CountsStore(outfile)
 
     def write_results_file(self, path, lines, lnotab, lines_hit, encoding=None):
         """Return a coverage results file in path."""
@@ -341,6 +653,278 @@ class CoverageResults:
 
         return n_hits, n_lines
 
+class _SourceLines:
+    """Source lines of files, read from memory maps.
+
+    Each file is mapped once, and an array of the offsets of its line
+    starts is built, so a line is decoded only when it is asked for
+    and the files are not kept in memory as lists of strings.  The
+    encoding comes from tokenize.detect_encoding(), and '\r\n' line
+    ends read as '\n', as in linecache.  At most max_maps files are
+    mapped at a time, since each map may hold a file descriptor; the
+    line offsets of the others are kept and their map is made again
+    when needed.
+
+    Like linecache, a mapped file is not checked for changes on every
+    lookup: the size and mtime are compared when a file is mapped
+    again, and by checkcache(), which drops the files that changed.
+    A file that is truncated in place while it is mapped can make
+    reading its lost lines fail with SIGBUS; editors and installers
+    replace files instead, which is safe.
+
+    The index of a file is built without holding the lock, since that
+    runs re and tokenize; the lock only covers the table of maps and
+    the reads from a map, so that a map is not closed while another
+    thread reads it.  It is reentrant for signal handlers, such as
+    the one of Trace.toggle_on_signals(), that look up lines.
+
+    What cannot be mapped, such as '<string>', files in zip archives,
+    files with lone '\r' line ends or bad encoding cookies, is left to
+    linecache.
+    """
+
+    max_maps = 256
+
+    def __init__(self):
+        # filename -> (encoding, line offsets, (size, mtime)) or None
+        self._files = {}
+        self._maps = OrderedDict()   # filename -> mmap or bytes, LRU
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _open_map(filename):
+        """Return (data, (size, mtime)) of filename, or None."""
+        try:
+            with open(filename, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if not st.st_size:
+                    data = b''
+                elif sys.version_info >= (3, 13):
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ,
+                                     trackfd=False)
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        return data, (st.st_size, st.st_mtime_ns)
+
+    def _keep_map(self, filename, data):
+        # Called with the lock held
+        self._maps[filename] = data
+        if len(self._maps) > self.max_maps:
+            _, old = self._maps.popitem(last=False)
+            if isinstance(old, mmap.mmap):
+                old.close()
+
+    def _drop(self, filename):
+        # Called with the lock held
+        self._files.pop(filename, None)
+        data = self._maps.pop(filename, None)
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    def _info(self, filename):
+        """Return (encoding, offsets, stat) of filename, or None."""
+        try:
+            return self._files[filename]
+        except KeyError:
+            pass
+        opened = self._open_map(filename)
+        info = None
+        if opened is not None:
+            data, stat = opened
+            info = self._build_index(data, stat)
+        with self._lock:
+            if filename in self._files:
+                # Another thread was quicker
+                info = self._files[filename]
+            else:
+                self._files[filename] = info
+                if info is not None:
+                    self._keep_map(filename, data)
+                    data = None
+        if opened is not None and isinstance(data, mmap.mmap):
+            data.close()
+        return info
+
+    def _build_index(self, data, stat):
+        if re.search(rb'\r(?!\n)', data):
+            return None
+        try:
+            encoding, _ = tokenize.detect_encoding(io.BytesIO(data[:4096])
+                                                   .readline)
+        except SyntaxError:
+            return None
+        size = len(data)
+        offsets = array('I' if size < 2 ** 32 else 'Q', [0])
+        offsets.extend(m.end() for m in re.finditer(rb'\n', data))
+        if offsets[-1] == size:
+            offsets.pop()
+        return encoding, offsets, stat
+
+    def _data(self, filename, info):
+        """The map of filename, made again if needed; None if the file
+        changed since it was indexed.  Called with the lock held."""
+        data = self._maps.get(filename)
+        if data is not None:
+            self._maps.move_to_end(filename)
+            return data
+        opened = self._open_map(filename)
+        if opened is None or opened[1] != info[2]:
+            if opened is not None and isinstance(opened[0], mmap.mmap):
+                opened[0].close()
+            self._drop(filename)
+            return None
+        self._keep_map(filename, opened[0])
+        return opened[0]
+
+    @staticmethod
+    def _line(data, encoding, offsets, index):
+        start = offsets[index]
+        end = offsets[index + 1] if index + 1 < len(offsets) else len(data)
+        line = data[start:end].decode(encoding, 'replace')
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+        elif not line.endswith('\n'):
+            # The last line, as linecache has it
+            line += '\n'
+        return line
+
+    def getline(self, filename, lineno):
+        """Line lineno of filename, as linecache.getline() returns it."""
+        for _ in range(2):
+            try:
+                info = self._files[filename]
+            except KeyError:
+                info = self._info(filename)
+            if info is None:
+                break
+            encoding, offsets, _ = info
+            with self._lock:
+                data = self._maps.get(filename)
+                if data is not None:
+                    self._maps.move_to_end(filename)
+                else:
+                    data = self._data(filename, info)
+                    if data is None:
+                        continue    # changed: index it again
+                if 1 <= lineno <= len(offsets):
+                    return self._line(data, encoding, offsets, lineno - 1)
+                return ''
+        return linecache.getline(filename, lineno)
+
+    def getlines(self, filename):
+        """All lines of filename, as linecache.getlines() returns them."""
+        for _ in range(2):
+            info = self._info(filename)
+            if info is None:
+                break
+            encoding, offsets, _ = info
+            with self._lock:
+                data = self._data(filename, info)
+                if data is None:
+                    continue
+                return [self._line(data, encoding, offsets, index)
+                        for index in range(len(offsets))]
+        return linecache.getlines(filename)
+
+    def encoding(self, filename):
+        """The encoding of filename, or None if it is not mapped."""
+        info = self._info(filename)
+        return info and info[0]
+
+    def checkcache(self):
+        """Drop the files whose size or mtime changed, or that are gone."""
+        with self._lock:
+            for filename, info in list(self._files.items()):
+                if info is None:
+                    continue
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    self._drop(filename)
+                    continue
+                if (st.st_size, st.st_mtime_ns) != info[2]:
+                    self._drop(filename)
+
+_source_lines = _SourceLines()
+
+def _write_cover_file(filename, coverpath, lines_hit, show_missing,
+                      cache_dir=None, results=None, store=None):
+    """Write the .cover file of one source file; return (hits, lines).
+
+    Module level so that write_results() can run it in worker processes,
+    where results is None and a plain CoverageResults writes the file.
+    store is a counts file, or its path, whose counts of filename are
+    added to lines_hit.
+    """
+    if store is not None:
+        if isinstance(store, str):
+            store = _CountsStore(store)
+            try:
+                stored = store.file_counts(filename)
+            finally:
+                store.close()
+        else:
+            stored = store.file_counts(filename)
+        for lineno, n in lines_hit.items():
+            stored[lineno] = stored.get(lineno, 0) + n
+        lines_hit = stored
+    # If desired, get a list of the line numbers which represent
+    # executable content (returned as a dict for better lookup speed)
+    if show_missing:
+        lnotab = _cached_executable_linenos(filename, cache_dir)
+    else:
+        lnotab = {}
+    source = _source_lines.getlines(filename)
+    encoding = _source_lines.encoding(filename)
+    if encoding is None:
+        with open(filename, 'rb') as fp:
+            encoding, _ = tokenize.detect_encoding(fp.readline)
+    if results is None:
+        results = CoverageResults()
+    return results.write_results_file(coverpath, source, lnotab, lines_hit,
+                                      encoding)
+
+def _cached_executable_linenos(filename, cache_dir):
+    """_find_executable_linenos() through the cache in cache_dir.
+
+    Each source file has one JSON entry, named after a hash of its
+    absolute path, holding the path, the file's mtime and size, the
+    Python version (which decides the line table) and the lines.  An
+    entry that does not match is recomputed and replaced.
+    """
+    if not cache_dir:
+        return _find_executable_linenos(filename)
+    path = os.path.abspath(filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return _find_executable_linenos(filename)
+    key = [path, st.st_mtime_ns, st.st_size, list(sys.version_info[:2])]
+    entry = os.path.join(cache_dir, hashlib.sha1(
+        path.encode('utf-8', 'surrogateescape')).hexdigest() + '.json')
+    try:
+        with open(entry, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return dict.fromkeys(cached['lines'], 1)
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    lnotab = _find_executable_linenos(filename)
+    if lnotab:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'key': key, 'lines': sorted(lnotab)}, f)
+            # Atomic, so concurrent reports never read half an entry
+            os.replace(tmp, entry)
+        except OSError as err:
+            print("trace: Could not cache the lines of %r: %s"
+                  % (filename, err), file=sys.stderr)
+    return lnotab
+
 def _find_lines_from_code(code, strs):
     """Return dict where keys are lines in the line number table."""
     linenos = {}
@@ -386,6 +970,188 @@ def _find_strings(filename, encoding=None):
             prev_ttype = ttype
     return d
 
+# Calls that write to the terminal.  Logging calls are not listed: their
+# output is written by the `.write(` in logging's StreamHandler.emit,
+# which is a site of its own, and whose logging frames are skipped when
+# the round is printed.
+_OUTPUT_FUNCS = ('print',)
+_OUTPUT_METHODS = ('write', 'writelines')
+_builtin_print = builtins.print
+
+def _find_output_linenos(filename):
+    """Return {lineno: end lineno} of the lines where an output call starts.
+
+    A call split over several lines is recorded at its first line, which
+    is where the line event for it fires; the end lineno is the last
+    line of the longest call starting there, see _early_call_events().
+    ``cprint(``, ``pprint(`` and other names that only end with "print"
+    are not output calls.
+    """
+    source = ''.join(_source_lines.getlines(filename))
+    if not source:
+        return {}
+    try:
+        tree = ast.parse(source, filename)
+    except (SyntaxError, ValueError):
+        return {}
+    linenos = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if ((isinstance(func, ast.Name) and func.id in _OUTPUT_FUNCS)
+                or (isinstance(func, ast.Attribute)
+                    and func.attr in _OUTPUT_METHODS)):
+            end = getattr(node, 'end_lineno', None) or node.lineno
+            linenos[node.lineno] = max(end, linenos.get(node.lineno, 0))
+    return linenos
+
+def _early_call_events(starts, file_sites):
+    """Return the offsets of the line events of a split output call that
+    fire before its arguments are evaluated.
+
+    starts is the findlinestarts() list of a code object and file_sites
+    the result of _find_output_linenos().  The first line of a call split
+    over several lines gets a line event, then its other lines do, then
+    the first line gets another one just before the call; only that last
+    one makes a round.
+    """
+    early = set()
+    for i, (offset, lineno) in enumerate(starts):
+        end = file_sites.get(lineno, lineno)
+        if end == lineno:
+            continue
+        for _, later in starts[i + 1:]:
+            if later == lineno:
+                early.add(offset)
+                break
+            if later is None or not lineno < later <= end:
+                break
+    return frozenset(early)
+
+def _capture_stack(frame):
+    """Return the (code, lineno) pairs of frame and all of its callers.
+
+    Unlike inspect.stack() this neither builds FrameInfo objects nor reads
+    any source; that is left to whoever prints the frames.
+    """
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return stack
+
+def _current_task():
+    """Return the asyncio task running in this thread, or None."""
+    # Only a program that imported asyncio can be running a task
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return None
+    loop = asyncio._get_running_loop()
+    if loop is None:
+        return None
+    return asyncio.current_task(loop)
+
+def _capture_task_stack(frame, task):
+    """Like _capture_stack(), for a frame run by an asyncio task.
+
+    The frames up to the task's coroutine are kept, but the event loop
+    frames under it are not.  They are replaced by the await chains of
+    the tasks waiting for the task, each innermost first, so that the
+    stack shows how the program got to the output and not which loop
+    callback resumed it.
+    """
+    stack = []
+    top = getattr(task.get_coro(), 'cr_frame', None)
+    while frame is not None:
+        stack.append((frame.f_code, frame.f_lineno))
+        if frame is top:
+            break
+        frame = frame.f_back
+    else:
+        # Not run by the task's coroutine (e.g. a done callback)
+        return stack
+    task = _awaiting_task(task)
+    while task is not None:
+        chain = []
+        coro = task.get_coro()
+        while getattr(coro, 'cr_frame', None) is not None:
+            chain.append((coro.cr_frame.f_code, coro.cr_frame.f_lineno))
+            coro = coro.cr_await
+        stack.extend(reversed(chain))
+        task = _awaiting_task(task)
+    return stack
+
+def _awaiting_task(fut):
+    """Return the task waiting for the future fut, or None.
+
+    A task awaiting fut has its wakeup method among fut's done
+    callbacks.  gather() and shield() add closures that refer to their
+    outer future instead, which is followed in turn.
+    """
+    seen = set()
+    todo = [fut]
+    while todo:
+        fut = todo.pop()
+        if id(fut) in seen:
+            continue
+        seen.add(id(fut))
+        for callback, _ in getattr(fut, '_callbacks', None) or ():
+            owner = getattr(callback, '__self__', None)
+            if owner is not None:
+                if hasattr(owner, 'get_coro'):
+                    return owner
+                continue
+            for cell in getattr(callback, '__closure__', None) or ():
+                try:
+                    value = cell.cell_contents
+                except ValueError:
+                    continue
+                if hasattr(value, 'add_done_callback'):
+                    todo.append(value)
+    return None
+
+# Instructions that start a code object before its first line runs; a
+# line with only these (the "def" line on 3.11+) gets no line event
+_PROLOGUE_OPS = frozenset(['RESUME', 'RETURN_GENERATOR', 'POP_TOP',
+                           'MAKE_CELL', 'COPY_FREE_VARS', 'NOP', 'CACHE'])
+
+def _traced_linenos(code):
+    """Return the set of lines of code that get line events."""
+    ops = {}
+    for instr in dis.get_instructions(code):
+        positions = getattr(instr, 'positions', None)
+        if positions is not None and positions.lineno is not None:
+            ops.setdefault(positions.lineno, set()).add(instr.opname)
+    return {lineno for _, lineno in dis.findlinestarts(code)
+            if lineno is not None
+            and not ops.get(lineno, {None}) <= _PROLOGUE_OPS}
+
+def _method_class(frame):
+    """Return the name of the class defining frame's method, or None.
+
+    The fallback of file_module_function_of() before Python 3.11, which
+    has no co_qualname: if the first argument is called self or cls,
+    the class is the one in its MRO whose attribute of that name has
+    the frame's code.
+    """
+    code = frame.f_code
+    if not code.co_argcount:
+        return None
+    first = code.co_varnames[0]
+    if first not in ('self', 'cls'):
+        return None
+    obj = frame.f_locals.get(first)
+    cls = obj if first == 'cls' and isinstance(obj, type) else type(obj)
+    for klass in cls.__mro__:
+        attr = klass.__dict__.get(code.co_name)
+        # staticmethod, classmethod and property wrap the function
+        for func in (attr, getattr(attr, '__func__', None),
+                     getattr(attr, 'fget', None)):
+            if getattr(func, '__code__', None) is code:
+                return klass.__name__
+    return None
+
 def _find_executable_linenos(filename):
     """Return dict where keys are line numbers in the line number table."""
     try:
@@ -400,10 +1166,1053 @@ def _find_executable_linenos(filename):
     strs = _find_strings(filename, encoding)
     return _find_lines(code, strs)
 
+class StackDiff:
+    """Find the part of a stack that repeats the previous stack.
+
+    Stacks are lists of hashable frames, e.g. (filename, lineno) pairs,
+    innermost first.  Frames are interned to small ints so that stacks
+    are compared as int lists, and the previous stack is kept as such a
+    list rather than copied.
+
+    diff() looks for the first frame of the current stack from which the
+    rest of the stack starts with a whole tail of the previous stack.
+    That is a search for a prefix of the reversed previous stack in the
+    reversed current stack, done with Knuth-Morris-Pratt in
+    O(len(previous) + len(current)) instead of comparing every pair of
+    frames.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._prev = []     # reversed ids of the previous stack
+        self._fail = []     # KMP failure table of self._prev
+
+    def intern(self, frame):
+        """Return the int id of frame, assigning a new one if needed."""
+        try:
+            return self._ids[frame]
+        except KeyError:
+            fid = self._ids[frame] = len(self._ids)
+            return fid
+
+    def diff(self, frames):
+        """Compare frames with the previous stack and remember them.
+
+        Returns None if no frame repeats, else (curr_at, prev_at,
+        prev_total): frames[curr_at:] starts with the previous stack's
+        frames from index prev_at to its end, prev_total being its
+        length.  curr_at is as small as possible, then prev_at.
+        """
+        pat = self._prev
+        fail = self._fail
+        m = len(pat)
+        ids = [self.intern(f) for f in reversed(frames)]
+        n = len(ids)
+
+        found = None
+        state = 0
+        if m:
+            for j, fid in enumerate(ids):
+                while state and (state == m or pat[state] != fid):
+                    state = fail[state - 1]
+                if pat[state] == fid:
+                    state += 1
+                if state:
+                    found = j, state
+
+        self._prev = ids
+        self._fail = _kmp_failure(ids)
+
+        if found is None:
+            return None
+        j, length = found
+        return n - 1 - j, m - length, m
+
+def _kmp_failure(seq):
+    """Return the Knuth-Morris-Pratt failure table of seq."""
+    fail = [0] * len(seq)
+    k = 0
+    for i in range(1, len(seq)):
+        while k and seq[i] != seq[k]:
+            k = fail[k - 1]
+        if seq[i] == seq[k]:
+            k += 1
+        fail[i] = k
+    return fail
+
+class StackTrie:
+    """Intern stacks in a trie and match rounds against earlier ones.
+
+    Stacks are lists of hashable frames, innermost first.  They are
+    stored root-side first, so stacks that share their outer frames
+    share a path in the trie, and each distinct stack gets a stable id:
+    the id of its last node.  The ids of the last `history` distinct
+    stacks are kept in LRU order along with the last round that had
+    each of them.
+
+    Each node remembers the last round that went through it and that
+    round's stack id; a round can refer to the node while that stack is
+    remembered.  Nodes that no remembered stack needs are pruned now and
+    then.
+    """
+
+    def __init__(self, history=1000):
+        self.history = history
+        self.rounds = 0
+        self._children = {}  # (parent node, frame) -> node
+        self._last = {}      # node -> (round, stack id) last through it
+        self._stacks = OrderedDict()  # stack id -> (round, n frames)
+        self._next_node = 1  # node 0 is the root
+        self._prune_at = 64 * history
+
+    def add(self, frames):
+        """Record frames as the next round.
+
+        Returns (round, stack_id, ref_round, ref_frames, shared): round is
+        the number of this round, from 1.  If an earlier remembered round
+        has the same outer frames, ref_round is that round, ref_frames its
+        number of frames and shared the number of outer frames in common,
+        taking the round with the most; otherwise those three are None,
+        None and 0.
+        """
+        self.rounds += 1
+        rnd = self.rounds
+        children, last, stacks = self._children, self._last, self._stacks
+
+        node = 0
+        ref = None
+        shared = 0
+        path = []
+        for frame in reversed(frames):
+            child = children.get((node, frame))
+            if child is None:
+                child = children[node, frame] = self._next_node
+                self._next_node += 1
+            else:
+                seen = last[child]
+                if seen[1] in stacks:
+                    ref = seen
+                    shared = len(path) + 1
+            node = child
+            path.append(node)
+
+        stack_id = node
+        ref_round = ref_frames = None
+        if ref:
+            ref_round = ref[0]
+            ref_frames = stacks[ref[1]][1]
+            # A use of the stack keeps it in the history
+            stacks.move_to_end(ref[1])
+
+        for node in path:
+            last[node] = rnd, stack_id
+        stacks[stack_id] = rnd, len(frames)
+        stacks.move_to_end(stack_id)
+        while len(stacks) > self.history:
+            stacks.popitem(last=False)
+        if len(last) > self._prune_at:
+            self._prune()
+        return rnd, stack_id, ref_round, ref_frames, shared
+
+    def _prune(self):
+        stacks = self._stacks
+        parents = {node: key[0] for key, node in self._children.items()}
+        keep = set()
+        for node, seen in self._last.items():
+            if seen[1] in stacks:
+                # Keep the whole path from the root to the node
+                while node and node not in keep:
+                    keep.add(node)
+                    node = parents[node]
+        self._last = {node: seen for node, seen in self._last.items()
+                      if node in keep}
+        self._children = {key: node for key, node in self._children.items()
+                          if node in keep}
+        self._prune_at = max(64 * self.history, 2 * len(keep))
+
+class SiteBudget:
+    """Limit the rounds printed for each output call site.
+
+    A site is the (filename, lineno) of the line that asked for output.
+    Each site may make at most `cap` rounds (0: no cap), only every
+    `sample`-th call of a site makes a round, and `rate` > 0 limits the
+    rounds of a site to that many per second with a token bucket that
+    holds up to max(rate, 1) tokens.  `global_rate` > 0 is a token
+    bucket shared by all sites.  sites maps (filename, lineno) to a
+    dict with 'cap', 'sample' and/or 'rate' keys overriding the
+    defaults for that site; filename may also be the tail of the path,
+    e.g. 'pkg/mod.py'.
+
+    admit() is called before the stack of a round is walked.  The
+    counts are not locked, so with many threads they are approximate.
+    """
+
+    def __init__(self, cap=0, sample=1, rate=0, global_rate=0, sites=None):
+        if sample < 1:
+            raise ValueError('sample must be >= 1')
+        self.cap = cap
+        self.sample = sample
+        self.rate = rate
+        self.global_rate = global_rate
+        self.sites = dict(sites or {})
+        # site -> [calls, rounds, cap, sample, rate, tokens, last time]
+        self._state = {}
+        self._tokens = max(global_rate, 1)
+        self._last = _time()
+
+    def admit(self, site):
+        """Count a call of site; return true iff it may make a round."""
+        state = self._state.get(site)
+        if state is None:
+            state = self._state[site] = self._new_state(site)
+        state[0] += 1
+        cap, sample, rate = state[2], state[3], state[4]
+        if cap and state[1] >= cap:
+            return False
+        if sample > 1 and (state[0] - 1) % sample:
+            return False
+        if rate or self.global_rate:
+            now = _time()
+            if rate:
+                tokens = min(max(rate, 1),
+                             state[5] + (now - state[6]) * rate)
+                state[6] = now
+                if tokens < 1:
+                    state[5] = tokens
+                    return False
+                state[5] = tokens - 1
+            if self.global_rate:
+                tokens = min(max(self.global_rate, 1),
+                             self._tokens + (now - self._last)
+                             * self.global_rate)
+                self._last = now
+                if tokens < 1:
+                    self._tokens = tokens
+                    if rate:
+                        state[5] += 1   # give the site's token back
+                    return False
+                self._tokens = tokens - 1
+        state[1] += 1
+        return True
+
+    def _new_state(self, site):
+        filename, lineno = site
+        limits = {'cap': self.cap, 'sample': self.sample, 'rate': self.rate}
+        for (name, line), override in self.sites.items():
+            if line == lineno and (filename == name or filename.endswith(
+                    os.sep + name.lstrip(os.sep))):
+                limits.update(override)
+                break
+        rate = limits['rate']
+        return [0, 0, limits['cap'], limits['sample'], rate,
+                max(rate, 1), _time()]
+
+    def suppressed(self):
+        """Return (site, suppressed, calls) for the sites that lost
+        rounds, most suppressed first."""
+        lost = [(site, state[0] - state[1], state[0])
+                for site, state in self._state.items()
+                if state[0] > state[1]]
+        lost.sort(key=lambda item: (-item[1], item[0]))
+        return lost
+
+    def config(self):
+        """Return the settings as JSON-able data, see from_config()."""
+        return {'cap': self.cap, 'sample': self.sample, 'rate': self.rate,
+                'global_rate': self.global_rate,
+                'sites': [[name, line, override] for (name, line), override
+                          in self.sites.items()]}
+
+    @classmethod
+    def from_config(cls, config):
+        config = dict(config)
+        sites = {(name, line): override
+                 for name, line, override in config.pop('sites')}
+        return cls(sites=sites, **config)
+
+class OutputFilter:
+    """Choose the output calls that make a round by what they output.
+
+    pattern is a regular expression searched in the text of a print()
+    or write() call, or in the message of a log record.  loggers is a
+    list of logger names, each also matching its child loggers, and
+    level the lowest level of the records to keep; when either is
+    given, only log records can match.  The output-sink backend asks
+    admit() before the stack of a round is walked, so the cost of the
+    rounds that do not match is one check of their payload.  A text
+    written in several write() calls is matched one call at a time.
+    """
+
+    def __init__(self, pattern=None, loggers=(), level=None):
+        self.pattern = pattern
+        self.loggers = list(loggers)
+        self.level = level
+        self._search = re.compile(pattern).search if pattern else None
+        self._logger_cache = {}   # logger name -> matches loggers
+
+    def admit(self, kind, args, kw):
+        """Return true iff the output call makes a round.
+
+        kind is 'print', 'write', 'writelines' or 'record', with the
+        arguments of print(), of stream.write()/writelines() or of
+        Handler.handle(record).
+        """
+        if kind == 'record':
+            return self._admit_record(args[0])
+        if self.loggers or self.level is not None:
+            return False
+        if self._search is None:
+            return True
+        if kind == 'print':
+            sep = kw.get('sep')
+            end = kw.get('end')
+            text = ((' ' if sep is None else sep).join(map(str, args))
+                    + ('\n' if end is None else end))
+        elif kind == 'writelines':
+            text = ''.join(map(str, args[0]))
+        else:
+            text = str(args[0])
+        return self._search(text) is not None
+
+    def _admit_record(self, record):
+        if self.level is not None and record.levelno < self.level:
+            return False
+        if self.loggers:
+            name = record.name
+            match = self._logger_cache.get(name)
+            if match is None:
+                match = self._logger_cache[name] = any(
+                    name == logger or name.startswith(logger + '.')
+                    for logger in self.loggers)
+            if not match:
+                return False
+        if self._search is None:
+            return True
+        try:
+            message = record.getMessage()
+        except Exception:
+            # The handler reports the bad arguments itself
+            message = str(record.msg)
+        return self._search(message) is not None
+
+    def config(self):
+        """Return the settings as JSON-able data, see from_config()."""
+        return {'pattern': self.pattern, 'loggers': self.loggers,
+                'level': self.level}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config)
+
+class _TraceStats:
+    """Counters and timers of the tracer's own work, for --stats.
+
+    count() adds to a named counter and add_time() to a named timer,
+    which also counts how often it ran.  Trace and _RoundPrinter call
+    them only when they were given one, so that without --stats the
+    hooks pay nothing; the call and line events are counted by
+    wrapping the trace functions, see counted_globaltrace().  Nothing
+    is locked, so with many threads the numbers are approximate.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.times = {}   # name -> [seconds, calls]
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        timer = self.times.get(name)
+        if timer is None:
+            timer = self.times[name] = [0.0, 0]
+        timer[0] += seconds
+        timer[1] += 1
+
+    def counted_globaltrace(self, globaltrace):
+        """Wrap a global trace function to count the call events, the
+        calls it ignored and the line events of the calls it traced."""
+        counts = self.counts
+        wrapped = {}   # local trace function -> its counting wrapper
+
+        def counted_local(localtrace):
+            def local(frame, why, arg):
+                if why == 'line':
+                    counts['line events'] = counts.get('line events', 0) + 1
+                if localtrace(frame, why, arg) is not None:
+                    return local
+            wrapped[localtrace] = local
+            return local
+
+        def trace(frame, why, arg):
+            if why == 'call':
+                counts['call events'] = counts.get('call events', 0) + 1
+            localtrace = globaltrace(frame, why, arg)
+            if localtrace is None:
+                if why == 'call':
+                    counts['call events ignored'] = (
+                        counts.get('call events ignored', 0) + 1)
+                return None
+            return wrapped.get(localtrace) or counted_local(localtrace)
+
+        return trace
+
+    def counted_line(self, callback):
+        """Wrap a sys.monitoring LINE callback to count its events."""
+        counts = self.counts
+
+        def line(code, line_number):
+            counts['line events'] = counts.get('line events', 0) + 1
+            return callback(code, line_number)
+
+        return line
+
+    def timed(self, name, func):
+        """Wrap func to add the time of each call to timer name."""
+        def timed(*args):
+            start = _perf_counter()
+            try:
+                return func(*args)
+            finally:
+                self.add_time(name, _perf_counter() - start)
+
+        return timed
+
+    def as_dict(self):
+        return {'counts': dict(sorted(self.counts.items())),
+                'times': {name: {'seconds': seconds, 'calls': calls}
+                          for name, (seconds, calls)
+                          in sorted(self.times.items())}}
+
+    def report(self, path=None):
+        """Print the numbers on sys.stderr, or dump them to path as JSON."""
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(self.as_dict(), f, indent=2)
+                f.write('\n')
+            return
+        print("trace: stats", file=sys.stderr)
+        for name, n in sorted(self.counts.items()):
+            print("  %-28s %12d" % (name, n), file=sys.stderr)
+        for name, (seconds, calls) in sorted(self.times.items()):
+            print("  %-28s %11.3fs in %d" % (name, seconds, calls),
+                  file=sys.stderr)
+
+class _RoundPrinter:
+    """Print rounds as [ NEW ]/[ EQU ] stacks on sys.stdout.
+
+    getline(filename, lineno) returns the source line shown for a frame,
+    by default from the mapped source files, see _SourceLines; the
+    replay of a recording passes one that reads the recorded lines.
+    A round is formatted into one string and written with a single
+    write under a lock, so it is not split up by the rounds of other
+    threads (colorama's stdout wrapper writes text piecewise).
+
+    With history > 0 rounds are numbered and matched against the last
+    `history` distinct stacks through a StackTrie instead of only the
+    previous round, and the frames a round shares with the earlier
+    round are not printed again.
+
+    Rounds are only compared with rounds of the same key, e.g. the
+    Thread object or asyncio task they come from, or the thread number
+    of a recording, each key having its own StackDiff or StackTrie; the
+    state of an object key such as a thread or task goes away with the
+    object.  A key's state is only used by one thread at a time (the
+    thread itself, or the background writer), so the comparison needs
+    no lock; the write lock is the only one taken.
+    """
+
+    def __init__(self, getline=None, history=0, stats=None):
+        self.history = history
+        self.stats = stats
+        if getline is None:
+            getline = _source_lines.getline
+        if stats is not None:
+            getline = stats.timed('source line lookups', getline)
+            self.format_round = stats.timed('render', self.format_round)
+            self.write = stats.timed('write', self.write)
+        self.getline = getline
+        self._states = {}   # key -> StackDiff or StackTrie
+        self._object_states = weakref.WeakKeyDictionary()
+        self._write_lock = threading.Lock()
+
+    def print_round(self, frames, skipped_at, t=None, tag=None, key=None):
+        """Print one round; t is the time to show, if any, tag a label
+        such as the thread or process it comes from and key the chain
+        of rounds it is compared with."""
+        self.write(self.format_round(frames, skipped_at, t, tag, key))
+
+    def write(self, text):
+        stream = sys.stdout
+        if isinstance(stream, _SinkStream):
+            # Don't report our own output to the output-sink backend
+            stream = stream._stream
+        with self._write_lock:
+            stream.write(text)
+            # Possible sys.stderr.write output on top first instead of bottom of round, so flush here
+            stream.flush()
+
+    def format_round(self, frames, skipped_at, t=None, tag=None, key=None):
+        """Return the text of one round, see print_round()."""
+        if key is None or type(key) is int:
+            states = self._states
+        else:
+            states = self._object_states
+        state = states.get(key)
+        if state is None:
+            state = states[key] = (StackTrie(self.history)
+                                   if self.history else StackDiff())
+        out = ['\n']
+        if tag is not None:
+            out.append('\x1b[7;39m[%s]\x1b[0m\x1b[K\n' % tag)
+        stats = self.stats
+        if stats is not None:
+            start = _perf_counter()
+        if self.history:
+            rnd, _, ref_round, ref_frames, shared = state.add(frames)
+        else:
+            same = state.diff(frames)
+        if stats is not None:
+            stats.add_time('stack diff', _perf_counter() - start)
+        if self.history:
+            out.append('\x1b[7;39m[Round #%d]\x1b[0m\x1b[K\n' % rnd)
+        if t is not None:
+            out.append(colored('\x1b[6;42m%s\t\t\t\t\t%.2fs' % (Fore.BLACK, t)) + '\n')
+            #out.append('\x1b[7;39m\t\t\t\t\tTime: %.2f\n' % t)
+        if self.history:
+            ci = len(frames) - shared
+            for ni, (filename, lineno) in enumerate(frames[:ci]):
+                if ni in skipped_at:
+                    out.append('\x1b[7;39m[Skipped logging ...]\x1b[0m\x1b[K\n')
+                self._format_frame(out, ni, filename, lineno, False)
+            if ref_round is not None:
+                if ci == 0 and ref_frames == shared:
+                    out.append("\x1b[3;39m\x1b[6;44m #1 [ EQU ] == Round #%d \x1b[0m\x1b[K\n" % ref_round)
+                else:
+                    out.append("\x1b[3;39m\x1b[6;44m #%d [ EQU ] == Round #%d #%d - #%d \x1b[0m\x1b[K\n" % (ci + 1, ref_round, ref_frames - shared + 1, ref_frames))
+            return ''.join(out)
+        # Note 1: Possible multiple print() get combine and so only print top print() code
+        equ_at = same[0] if same else len(frames)
+
+        for ci, (filename, lineno) in enumerate(frames):
+
+            if ci in skipped_at:
+                out.append('\x1b[7;39m[Skipped logging ...]\x1b[0m\x1b[K\n')
+
+            if ci == equ_at:
+                prev_break_at, prev_total = same[1] + 1, same[2]
+                if prev_break_at == prev_total:
+                    out.append("\x1b[3;39m\x1b[6;44m #" + str(ci + 1) + " [ EQU ] == Previous #" + str(prev_break_at) + " \x1b[0m\x1b[K\n")
+                else:
+                    out.append("\x1b[3;39m\x1b[6;44m #" + str(ci + 1) + " [ EQU ] == Previous #" + str(prev_break_at) + ' - #' + str(prev_total) + " \x1b[0m\x1b[K\n")
+
+            self._format_frame(out, ci, filename, lineno, ci >= equ_at)
+        return ''.join(out)
+
+    def _format_frame(self, out, ci, filename, lineno, equ):
+        if equ:
+            out.append(colored( ''.join([ '\x1b[0m\x1b[K\x1b[6;44m', Fore.LIGHTWHITE_EX , ' #', str(ci + 1), ' [ EQU ] ' ]), attrs=BOLD_ONLY))
+            #tag = '\x1b[7;39m#' + str(ci + 1) + ' [Equal] '
+        else:
+            #, Fore.LIGHTRED_EX
+            out.append(colored( ''.join([ '\x1b[0m\x1b[K\x1b[6;42m', Fore.BLACK, ' #', str(ci + 1), ' [ NEW ] ' ]), attrs=BOLD_ONLY))
+            #tag = '\x1b[5m\x1b[6;32m#' + str(ci + 1) + ' [ New ]'
+
+        # Only the printed frames read their source line
+        code_context = self.getline(filename, lineno)
+        if not code_context: # possible None for top 2 func, at `shutil.make_archive(epub_name_with_path, 'zip', self.EPUB_DIR)` which involved shutil.py and zipfile.py
+            code_context = '<None>'
+        out.append(colored("\x1b[0m\x1b[K \x1b[17;36m%s\x1b[0m\x1b[K\n       \x1b[7;36m(%d): %s %s\x1b[0m\x1b[K" % (filename, lineno,
+                    Fore.LIGHTWHITE_EX, code_context)) + '\n')
+
+class _RoundWriter:
+    """Format and write rounds on a background thread.
+
+    Rounds are taken from a bounded queue and written in batches, so the
+    traced threads neither format rounds nor wait for the terminal.  When
+    the queue is full, submit() waits if policy is 'block', or drops the
+    round and counts it in self.dropped if policy is 'drop'.  Rounds are
+    written in the order they were submitted; the program's own output
+    can get ahead of the rounds still in the queue.
+    """
+
+    batch_size = 64
+
+    def __init__(self, printer, maxsize, policy='block'):
+        if policy not in ('block', 'drop'):
+            raise ValueError('unknown render policy %r' % (policy,))
+        self._printer = printer
+        self._queue = queue.Queue(maxsize)
+        self._block = policy == 'block'
+        self._thread = None
+        self.dropped = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='pylogtrace-writer',
+                                            daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def submit(self, frames, skipped_at, t=None, tag=None, key=None):
+        if self._block:
+            self._queue.put((frames, skipped_at, t, tag, key))
+        else:
+            try:
+                self._queue.put_nowait((frames, skipped_at, t, tag, key))
+            except queue.Full:
+                self.dropped += 1
+
+    def flush(self):
+        """Wait until every submitted round has been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def in_writer(self):
+        """Return true iff called from the writer thread.
+
+        Its writes are rounds, not output to report: sys.monitoring
+        events and the hooks set by start() reach every thread, and a
+        round made here would be queued to the writer itself, which
+        hangs once the queue is full.
+        """
+        return threading.current_thread() is self._thread
+
+    def _run(self):
+        # The threading hooks are inherited; this thread is not traced
+        # by them, but see in_writer()
+        sys.settrace(None)
+        sys.setprofile(None)
+        get, get_nowait = self._queue.get, self._queue.get_nowait
+        format_round = self._printer.format_round
+        while True:
+            batch = [get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self._printer.write(''.join(format_round(*item)
+                                            for item in batch))
+            except (OSError, ValueError):
+                # stdout is gone (closed or a broken pipe); keep draining
+                # so that flush() does not hang
+                pass
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+class _CallGraph:
+    """Call counts and times per caller -> callee edge.
+
+    Fed by a profile hook: Python calls are keyed by code object, calls
+    of C functions by their name.  That name is made once per function:
+    a c_call looks it up by the function's __name__ and its module, or
+    the type of the object a method is bound to.  Each thread keeps its own stack of
+    [key, path id, start time, time of children]; a return adds the
+    call's inclusive and exclusive (inclusive minus children) time to
+    its edge.  Times come from time.perf_counter(), and include some of
+    the hook's own overhead.
+
+    The calling paths are interned in a trie of path ids.  With format
+    'collapsed' the exclusive time of each path is written to the file
+    as "frame;frame;... microseconds" lines, for flame graph tools,
+    whenever flush_size paths have time; a path may then be on several
+    lines, which the tools add up.  With format 'callgrind' the edges
+    are written at the end in the callgrind format, for KCachegrind
+    and similar viewers.  The tables are shared by all threads without
+    a lock, so with many threads the numbers are approximate.
+    """
+
+    flush_size = 10000
+
+    def __init__(self, path, fmt, name_of, own_file):
+        if fmt not in ('collapsed', 'callgrind'):
+            raise ValueError('unknown call graph format %r' % (fmt,))
+        self.path = path
+        self.format = fmt
+        self._name_of = name_of     # frame -> (filename, module, funcname)
+        self._own_file = own_file   # calls made by the tracer are left out
+        self._local = threading.local()
+        self._edges = {}   # (caller key, callee key) -> [calls, incl, excl]
+        self._labels = {}  # key -> (filename, lineno, funcname)
+        self._c_keys = {}  # (__name__, module or type) -> C function key
+        self._paths = {}   # (parent path id, key) -> path id
+        self._nodes = [None]  # path id -> (parent path id, key); 0 is root
+        self._path_labels = {0: ''}
+        self._path_times = {}  # path id -> exclusive time not yet written
+        self._file = open(path, 'w') if fmt == 'collapsed' else None
+
+    def profile(self, frame, why, arg):
+        code = frame.f_code
+        if code.co_filename == self._own_file:
+            return
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if why == 'call' or why == 'c_call':
+            if why == 'call':
+                key = code
+                if key not in self._labels:
+                    self._labels[key] = (code.co_filename, code.co_firstlineno,
+                                         self._name_of(frame)[2])
+            else:
+                owner = getattr(arg, '__self__', None)
+                if owner is not None and type(owner) is not _ModuleType:
+                    # A bound method: a new object on every lookup
+                    owner = type(owner)
+                c_key = getattr(arg, '__name__', None), owner
+                key = self._c_keys.get(c_key)
+                if key is None:
+                    key = self._c_keys[c_key] = _c_function_name(arg)
+                    if key not in self._labels:
+                        self._labels[key] = ('~', 0, key)
+            parent_path = stack[-1][1] if stack else 0
+            path = self._paths.get((parent_path, key))
+            if path is None:
+                path = self._paths[parent_path, key] = len(self._nodes)
+                self._nodes.append((parent_path, key))
+            stack.append([key, path, _perf_counter(), 0.0])
+            return
+        if why == 'return':
+            # Drop the calls whose return was not seen
+            while stack and stack[-1][0] is not code:
+                stack.pop()
+        elif why != 'c_return' and why != 'c_exception':
+            return
+        elif stack and type(stack[-1][0]) is not str:
+            return
+        if not stack:
+            return
+        key, path, start, children = stack.pop()
+        elapsed = _perf_counter() - start
+        exclusive = elapsed - children
+        if stack:
+            stack[-1][3] += elapsed
+            edge_key = stack[-1][0], key
+        else:
+            edge_key = None, key
+        edge = self._edges.get(edge_key)
+        if edge is None:
+            self._edges[edge_key] = [1, elapsed, exclusive]
+        else:
+            edge[0] += 1
+            edge[1] += elapsed
+            edge[2] += exclusive
+        times = self._path_times
+        times[path] = times.get(path, 0.0) + exclusive
+        if len(times) > self.flush_size and self._file is not None:
+            self._flush()
+
+    def _flush(self):
+        times, self._path_times = self._path_times, {}
+        lines = []
+        for path, t in list(times.items()):
+            us = round(t * 1e6)
+            if us > 0:
+                lines.append('%s %d\n' % (self._path_label(path), us))
+        self._file.writelines(lines)
+
+    def _path_label(self, path):
+        label = self._path_labels.get(path)
+        if label is None:
+            parent, key = self._nodes[path]
+            filename, lineno, funcname = self._labels[key]
+            if filename == '~':
+                frame = funcname
+            else:
+                frame = '%s (%s:%d)' % (funcname, filename, lineno)
+            frame = frame.replace(';', ':')
+            label = self._path_label(parent)
+            label = self._path_labels[path] = (label + ';' + frame
+                                               if label else frame)
+        return label
+
+    def open(self):
+        """Reopen the output file after close(), when tracing restarts."""
+        if self.format == 'collapsed' and self._file is None:
+            self._file = open(self.path, 'a')
+
+    def close(self):
+        """Write what is left and close the output file."""
+        if self._file is not None:
+            self._flush()
+            self._file.close()
+            self._file = None
+        elif self.format == 'callgrind':
+            with open(self.path, 'w') as f:
+                self._write_callgrind(f)
+
+    def _write_callgrind(self, f):
+        self_cost = {}
+        calls = {}
+        for (caller, callee), (n, inclusive, exclusive) in self._edges.items():
+            self_cost[callee] = self_cost.get(callee, 0.0) + exclusive
+            if caller is not None:
+                calls.setdefault(caller, []).append((callee, n, inclusive))
+        f.write('# callgrind format\nversion: 1\ncreator: pylogtrace\n'
+                'positions: line\nevents: us\n')
+        f.write('summary: %d\n' % round(sum(self_cost.values()) * 1e6))
+        labels = self._labels
+        for key in sorted(self_cost, key=lambda key: labels[key]):
+            filename, lineno, funcname = labels[key]
+            f.write('\nfl=%s\nfn=%s\n%d %d\n' % (
+                filename, funcname, lineno, round(self_cost[key] * 1e6)))
+            for callee, n, inclusive in sorted(
+                    calls.get(key, ()), key=lambda c: labels[c[0]]):
+                cfilename, clineno, cfuncname = labels[callee]
+                f.write('cfl=%s\ncfn=%s\ncalls=%d %d\n%d %d\n' % (
+                    cfilename, cfuncname, n, clineno, lineno,
+                    round(inclusive * 1e6)))
+
+def _c_function_name(func):
+    """Return a name such as builtins.len or list.append for a C
+    function seen by a profile hook."""
+    name = getattr(func, '__qualname__', None) or repr(func)
+    module = getattr(func, '__module__', None)
+    if module:
+        return '%s.%s' % (module, name)
+    owner = getattr(func, '__self__', None)
+    if owner is not None and '.' not in name:
+        return '%s.%s' % (type(owner).__qualname__, name)
+    return name
+
+# --record/--replay file format.  A recording is a sequence of records,
+# each a one-byte tag followed by a little-endian struct:
+#   H  header: magic, format version, pid, start time (time.time())
+#   S  string table entry: id, byte length, then the UTF-8 bytes
+#   F  frame: id, filename string id, lineno, source line string id
+#   R  round: index, time, thread number, number of frames, number of
+#      "[Skipped logging ...]" markers, then that many frame ids and
+#      marker positions as uint32
+# Thread numbers count the threads of a run from 1, in the order of
+# their first round; unlike thread idents they are never reused.
+# A run appends a new H record, which starts new string and frame
+# tables, so several runs can share one file.
+_REC_MAGIC = b'PLTR'
+_REC_VERSION = 1
+_rec_header = struct.Struct('<4sBId')
+_rec_string = struct.Struct('<II')
+_rec_frame = struct.Struct('<IIiI')
+_rec_round = struct.Struct('<IdQII')
+
+class _RoundRecorder:
+    """Append rounds to a file in the --record format.
+
+    Filenames and source lines are written once, so a round costs a
+    few dict lookups and one short write to a buffered file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'ab')
+        self._strings = {}
+        self._frames = {}
+        self._index = 0
+        self._threads = weakref.WeakKeyDictionary() # Thread -> number
+        self._thread_count = 0
+        self._lock = threading.Lock()
+        # Set in forked children, which may leave through os._exit()
+        self.autoflush = False
+        self._file.write(b'H' + _rec_header.pack(_REC_MAGIC, _REC_VERSION,
+                                                 os.getpid(), time.time()))
+
+    def _string(self, s):
+        sid = self._strings.get(s)
+        if sid is None:
+            sid = self._strings[s] = len(self._strings)
+            data = s.encode('utf-8', 'surrogateescape')
+            self._file.write(b'S' + _rec_string.pack(sid, len(data)) + data)
+        return sid
+
+    def _frame(self, frame):
+        fid = self._frames.get(frame)
+        if fid is None:
+            filename, lineno = frame
+            fid = self._frames[frame] = len(self._frames)
+            self._file.write(b'F' + _rec_frame.pack(
+                fid, self._string(filename), lineno or 0,
+                self._string(_source_lines.getline(filename, lineno or 0))))
+        return fid
+
+    def record(self, frames, skipped_at):
+        thread = threading.current_thread()
+        with self._lock:
+            number = self._threads.get(thread)
+            if number is None:
+                self._thread_count += 1
+                number = self._threads[thread] = self._thread_count
+            ids = [self._frame(f) for f in frames]
+            ids.extend(sorted(skipped_at))
+            self._index += 1
+            self._file.write(b'R' + _rec_round.pack(
+                self._index, time.time(), number,
+                len(frames), len(skipped_at)))
+            self._file.write(struct.pack('<%dI' % len(ids), *ids))
+            if self.autoflush:
+                self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+def _read_rounds(path, sources):
+    """Yield (pid, start, when, thread, frames, skipped_at) per round.
+
+    frames are (filename, lineno) pairs; their recorded source lines are
+    added to the sources dict.  A truncated last record is ignored.
+    """
+    with open(path, 'rb') as f:
+        strings = frames = None
+        pid = start = None
+        while True:
+            tag = f.read(1)
+            if not tag:
+                return
+            try:
+                if tag == b'H':
+                    magic, version, pid, start = _read_struct(f, _rec_header)
+                    if magic != _REC_MAGIC or version != _REC_VERSION:
+                        raise ValueError('not a pylogtrace recording')
+                    strings, frames = {}, {}
+                elif strings is None:
+                    raise ValueError('not a pylogtrace recording')
+                elif tag == b'S':
+                    sid, size = _read_struct(f, _rec_string)
+                    data = f.read(size)
+                    if len(data) != size:
+                        return
+                    strings[sid] = data.decode('utf-8', 'surrogateescape')
+                elif tag == b'F':
+                    fid, name_id, lineno, source_id = _read_struct(f, _rec_frame)
+                    frame = frames[fid] = strings[name_id], lineno
+                    sources[frame] = strings[source_id]
+                elif tag == b'R':
+                    index, when, tid, nframes, nskipped = _read_struct(
+                        f, _rec_round)
+                    ids = _read_struct(f, struct.Struct('<%dI'
+                                                        % (nframes + nskipped)))
+                    yield (pid, start, when, tid,
+                           [frames[fid] for fid in ids[:nframes]],
+                           set(ids[nframes:]))
+                else:
+                    raise ValueError('bad record tag %r' % tag)
+            except EOFError:
+                return
+
+def _read_struct(f, st):
+    data = f.read(st.size)
+    if len(data) != st.size:
+        raise EOFError
+    return st.unpack(data)
+
+def replay_rounds(path, timing=False, pattern=None, thread=None, history=0,
+                  merge=False):
+    """Print the rounds recorded in path as --trace would have.
+
+    pattern is a regex; only rounds with a frame whose filename or
+    source line matches it are printed.  thread is a thread number; only
+    that thread's rounds are printed.  [ EQU ] refers to the previous
+    printed round, or with history > 0 to any of the rounds with the
+    last `history` distinct stacks.
+
+    With merge, the recordings of the child processes (path.<pid>) are
+    read too, and the rounds of all processes are printed in time
+    order, each tagged with its pid and compared with the rounds of its
+    own process only.
+
+    Rounds are compared with the rounds of their own thread; those of
+    any thread but the first one of a process are tagged with its number.
+    """
+    sources = {}
+    getline = lambda filename, lineno: sources.get((filename, lineno), '')
+    printers = {}
+    first_threads = {}  # pid -> id of its first thread
+    rx = re.compile(pattern) if pattern else None
+    if merge:
+        rounds = heapq.merge(*[_read_rounds(p, sources)
+                               for p in _child_recordings(path)],
+                             key=lambda r: r[2])
+    else:
+        rounds = _read_rounds(path, sources)
+    for pid, start, when, tid, frames, skipped_at in rounds:
+        if thread is not None and tid != thread:
+            continue
+        if rx is not None and not any(rx.search(filename)
+                                      or rx.search(sources[filename, lineno])
+                                      for filename, lineno in frames):
+            continue
+        printer = printers.get(pid)
+        if printer is None:
+            printer = printers[pid] = _RoundPrinter(getline, history)
+        tags = ['pid %d' % pid] if merge else []
+        if first_threads.setdefault(pid, tid) != tid:
+            tags.append('thread %d' % tid)
+        printer.print_round(frames, skipped_at,
+                            when - start if timing else None,
+                            ' '.join(tags) or None, tid)
+
+def _child_recordings(path):
+    """Return path and the path.<pid> files written by its children."""
+    dirname, base = os.path.split(os.path.abspath(path))
+    prefix = base + '.'
+    children = [os.path.join(dirname, name) for name in os.listdir(dirname)
+                if name.startswith(prefix) and name[len(prefix):].isdigit()]
+    return [path] + sorted(children)
+
+# --follow-children: Python children started with this environment
+# import this sitecustomize first, which starts tracing them.
+_CHILD_ENV = 'PYLOGTRACE_CHILD'
+_CHILD_SITECUSTOMIZE = '''\
+# Written by pylogtrace --follow-children.  Runs the sitecustomize this
+# one shadows, if any, and starts tracing this process.
+import os, sys
+import importlib.machinery, importlib.util
+_here = os.path.dirname(os.path.abspath(__file__))
+if _here in sys.path:
+    sys.path.remove(_here)
+_spec = importlib.machinery.PathFinder.find_spec('sitecustomize', sys.path)
+if _spec is not None:
+    _mod = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_mod)
+sys.path.insert(0, %r)
+try:
+    import pylogtrace
+finally:
+    del sys.path[0]
+pylogtrace._trace_child()
+'''
+
+def _trace_child():
+    """Trace this process for a parent run with --follow-children."""
+    config = json.loads(os.environ[_CHILD_ENV])
+    base = config['record']
+    t = Trace(count=0, trace=1, ignoremods=config['ignoremods'],
+              ignoredirs=config['ignoredirs'], backend=config['backend'],
+              record='%s.%d' % (base, os.getpid()), follow_children=True,
+              asyncio_tasks=config['asyncio_tasks'],
+              budget=config['budget'] and SiteBudget.from_config(
+                  config['budget']),
+              output_filter=config['output_filter']
+                  and OutputFilter.from_config(config['output_filter']))
+    t._record_base = base
+    t._install()
+    atexit.register(t._uninstall)
+
 class Trace:
+    # No longer used: the output-site index replaced the regex test of
+    # every traced line.  Kept, compiled once, for code that reads them.
+    cprint_regex = re.compile(r'\Sprint\(')
+    print_regex = re.compile(r'print\s*\(')
+
     def __init__(self, count=1, trace=1, countfuncs=0, countcallers=0,
                  ignoremods=(), ignoredirs=(), infile=None, outfile=None,
-                 timing=False):
+                 timing=False, backend=None, record=None, render_queue=0,
+                 render_policy='block', history=0, follow_children=False,
+                 asyncio_tasks=False, budget=None, first_hit=False,
+                 callgraph=None, callgraph_format='collapsed', stats=False,
+                 output_filter=None):
         """
         @param count true iff it should count number of times each
                      line is executed
@@ -420,55 +2229,192 @@ class Trace:
                      added into the results
         @param outfile file in which to write the results
         @param timing true iff timing information be displayed
+        @param backend 'settrace' or 'monitoring' to force the hooks used
+                     by the log-trace mode; None picks sys.monitoring
+                     when the interpreter has it.  'sink' traces no
+                     lines at all and wraps the output functions instead,
+                     'profile' only looks at calls of builtin print and
+                     of the write methods of io objects
+        @param record file to append the log-trace rounds to, in binary
+                     form, instead of printing them; see replay_rounds()
+        @param render_queue if > 0, rounds are formatted and printed by a
+                     background thread, taking them from a queue of
+                     this size
+        @param render_policy 'block' to wait when that queue is full,
+                     'drop' to drop the round and count it
+        @param history if > 0, number the rounds and let a round refer to
+                     any of the last `history` distinct stacks instead of
+                     only the previous round
+        @param follow_children true iff forked children and Python
+                     processes started by the program are traced too;
+                     each records to <record>.<pid>, so record must be
+                     given.  See replay_rounds(merge=True)
+        @param asyncio_tasks true iff the output of an asyncio task is
+                     shown with the await chain of the tasks waiting for
+                     it instead of the event loop frames, tagged with
+                     the task name and compared with that task's
+                     earlier rounds only
+        @param budget a SiteBudget limiting the rounds of each output
+                     call site; the rounds it suppressed are listed on
+                     sys.stderr at the end
+        @param first_hit true iff `count' only records whether each
+                     line ran: a line is counted once, as 1, and then no
+                     longer traced.  Only for counting alone; picks
+                     sys.monitoring when the interpreter has it
+        @param callgraph file to write a call graph to, with call counts
+                     and times per caller/callee edge; this overrides
+                     `count' and `trace'
+        @param callgraph_format 'collapsed' for flame graph stacks,
+                     'callgrind' for the callgrind format
+        @param stats true iff the tracer counts and times its own work
+                     in self.stats, a _TraceStats; see its report()
+        @param output_filter an OutputFilter choosing the output calls
+                     that make a round by their text or log record;
+                     only the output-sink backend sees those, so it
+                     is picked when backend is None
         """
 
 
         #hole:
-        #self.f_d = {}
-        #self.f_dM = {}
         #self.pre_logging = None
         #self.pre_loggingM = None
         self.t = 0
-        self.cprint_regex = re.compile(r'\Sprint\(')
-        self.print_regex = re.compile(r'print\s*\(')
         self.logging_regex = logging.__file__ # re.compile(''.join(['\\', os.sep, r'logging', '\\', os.sep]))
         self.trace_regex = __file__
         self.traceback_regex = traceback.__file__
         self.log_tb_file = (self.logging_regex, self.traceback_regex)
-        self.prev_ist = []
-        self.prev_full_index = 0
+        self.stats = _TraceStats() if stats else None
+        self._printer = _RoundPrinter(history=history, stats=self.stats)
+        self._recorder = _RoundRecorder(record) if record else None
+        self._record_base = record
+        self.follow_children = follow_children
+        if follow_children and not record:
+            raise ValueError('following child processes needs record')
+        self.asyncio_tasks = asyncio_tasks
+        self.budget = budget
+        self._budget_reported = {} # site -> rounds lost, as last printed
+        self.output_filter = output_filter
+        if output_filter is not None:
+            if backend is None:
+                backend = 'sink'
+            elif backend != 'sink':
+                raise ValueError('output_filter needs the sink backend')
+        self._child_config = {'ignoremods': list(ignoremods),
+                              'ignoredirs': list(ignoredirs),
+                              'backend': backend,
+                              'asyncio_tasks': asyncio_tasks,
+                              'budget': budget and budget.config(),
+                              'output_filter': (output_filter
+                                                and output_filter.config()),
+                              'record': os.path.abspath(record or '')}
+        self._fork_hooked = False
+        self._installed = False # between _install() and _uninstall()
+        self._saved_env = None
+        self._writer = None
+        if render_queue > 0:
+            self._writer = _RoundWriter(self._printer, render_queue,
+                                        render_policy)
+        self._file_sites = {} # filename -> lines with output calls
+        self._code_sites = {} # code object -> frozenset of those lines
+        # code object -> offsets of line events to skip at those lines,
+        # see _early_call_events(); only codes with split output calls
+        self._early_events = {}
 
 
         self.infile = infile
         self.outfile = outfile
         self.ignore = _Ignore(ignoremods, ignoredirs)
+        self.ignore.stats = self.stats
         self.counts = {}   # keys are (filename, linenumber)
+        # --count keeps the counts of each code object in an array
+        # indexed by lineno - base; see _line_counter() and results()
+        self._line_counts = {} # code object -> (base, array of counts)
+        self._line_tracers = {} # code object -> its local trace function
+        # code object -> local trace function or None, see globaltrace_lt
+        self._code_traces = {}
+        self._code_ignored = {} # code object -> ignore decision
         self.pathtobasename = {} # for memoizing os.path.basename
         self.donothing = 0
         self.trace = trace
+        # --count modes: _line_tracer() makes the local trace functions
+        self._counting = 0
         self._calledfuncs = {}
         self._callers = {}
-        self._caller_cache = {}
+        self._caller_cache = OrderedDict() # code -> file_module_function_of
+        self._caller_cache_size = 10000
         self.start_time = None
         if timing:
             self.start_time = _time()
-        if countcallers:
+        self._callgraph = None
+        if callgraph:
+            # Calls and returns come from a profile hook, see _install()
+            self._callgraph = _CallGraph(callgraph, callgraph_format,
+                                         self.file_module_function_of,
+                                         self.trace_regex)
+            count = trace = countfuncs = countcallers = 0
+        elif countcallers:
             self.globaltrace = self.globaltrace_trackcallers
         elif countfuncs:
             self.globaltrace = self.globaltrace_countfuncs
-        elif trace and count:
+        elif count:
             self.globaltrace = self.globaltrace_lt
-            self.localtrace = self.localtrace_trace_and_count
+            self._counting = 1
+            # Not used by globaltrace_lt, which returns the tracers of
+            # _line_tracer(); kept for callers of the trace.py API
+            if trace:
+                self.localtrace = self.localtrace_trace_and_count
+            else:
+                self.localtrace = self.localtrace_count
         elif trace:
             self.globaltrace = self.globaltrace_lt
             self.localtrace = self.localtrace_trace
-        elif count:
-            self.globaltrace = self.globaltrace_lt
-            self.localtrace = self.localtrace_count
         else:
             # Ahem -- do nothing?  Okay.
             self.donothing = 1
 
+        if backend not in (None, 'settrace', 'monitoring', 'sink', 'profile'):
+            raise ValueError('unknown backend %r' % (backend,))
+        if backend == 'monitoring' and not _HAVE_MONITORING:
+            raise ValueError('the monitoring backend needs Python 3.12+')
+        # Only the pure log-trace mode knows which lines it cares about,
+        # so it is the only one that can switch the rest off; the
+        # first-hit count switches off every line it has seen.
+        log_trace_only = trace and not (count or countfuncs or countcallers)
+        count_only = count and not (trace or countfuncs or countcallers)
+        if first_hit and not count_only:
+            raise ValueError('first_hit only works when counting alone')
+        self.first_hit = first_hit
+        if backend in (None, 'settrace'):
+            self.backend = 'settrace'
+            if (backend is None and (log_trace_only or first_hit)
+                    and _HAVE_MONITORING):
+                self.backend = 'monitoring'
+        elif backend == 'monitoring' and first_hit:
+            self.backend = backend
+        elif not log_trace_only:
+            raise ValueError('the %s backend only works for the log-trace '
+                             'mode' % backend)
+        else:
+            self.backend = backend
+        if callgraph:
+            self.backend = 'callgraph'
+        self._monitored = []
+        self._monitor_tool = None
+        if _HAVE_MONITORING:
+            self._monitor_tool = (sys.monitoring.COVERAGE_ID if first_hit
+                                  else sys.monitoring.DEBUGGER_ID)
+        self._sink_local = threading.local()
+        self._sink_saved = None
+        self._started = False   # see start()
+        self._entered = []
+        self._wrapper_codes = set()   # see traced()
+        if self.stats is not None:
+            self._code_trace = self.stats.timed('call filter decisions',
+                                                self._code_trace)
+            if not self.donothing and not callgraph:
+                self.globaltrace = self.stats.counted_globaltrace(
+                    self.globaltrace)
+
     def run(self, cmd):
         import __main__
         dict = __main__.__dict__
@@ -478,14 +2424,168 @@ class Trace:
         if globals is None: globals = {}
         if locals is None: locals = {}
         if not self.donothing:
-            threading.settrace(self.globaltrace)
-            sys.settrace(self.globaltrace)
+            self._install()
+        start = _perf_counter()
         try:
             exec(cmd, globals, locals)
         finally:
             if not self.donothing:
-                sys.settrace(None)
+                # Off here, so that _uninstall() itself is not traced
+                if self.backend in ('profile', 'callgraph'):
+                    sys.setprofile(None)
+                elif self.backend == 'monitoring':
+                    sys.monitoring.set_events(self._monitor_tool, 0)
+                elif self.backend != 'sink':
+                    sys.settrace(None)
+                self._uninstall()
+            if self.stats is not None:
+                self.stats.add_time('traced run', _perf_counter() - start)
+
+    def _install(self, all_threads=False):
+        self._installed = True
+        if self.follow_children:
+            self._follow_children()
+        if self._writer is not None:
+            # Before the hooks, so that the thread is not traced
+            self._writer.start()
+        if self.backend == 'sink':
+            self._sink_start()
+            return
+        if self.backend in ('profile', 'callgraph'):
+            if self.backend == 'profile':
+                profile = self.profile_c_calls
+            else:
+                self._callgraph.open()
+                profile = self._callgraph.profile
+            if all_threads and _HAVE_ALL_THREADS:
+                threading.setprofile_all_threads(profile)
+            else:
+                threading.setprofile(profile)
+            sys.setprofile(profile)
+            return
+        if self.backend == 'monitoring':
+            if self._monitoring_start(hook_running=all_threads):
+                return
+            # The tool id is taken (a debugger or coverage tool is
+            # already attached), so fall back to the old hooks.
+            self.backend = 'settrace'
+        if all_threads:
+            # Before the hooks: the calls made while hooking the frames
+            # must not be traced themselves
+            self._hook_running_frames()
+            if _HAVE_ALL_THREADS:
+                threading.settrace_all_threads(self.globaltrace)
+        if not (all_threads and _HAVE_ALL_THREADS):
+            threading.settrace(self.globaltrace)
+        sys.settrace(self.globaltrace)
+
+    def _running_frames(self):
+        """Yield the frames of the threads whose hooks _install() set."""
+        if _HAVE_ALL_THREADS or self.backend == 'monitoring':
+            tops = list(sys._current_frames().values())
+        else:
+            tops = [sys._getframe()]
+        for frame in tops:
+            while frame is not None:
+                if frame.f_code.co_filename != self.trace_regex:
+                    yield frame
+                frame = frame.f_back
+
+    def _hook_running_frames(self):
+        """Trace the frames that were already running, so that a loop
+        that was entered before tracing started is traced too; the hooks
+        themselves only see new calls."""
+        for frame in self._running_frames():
+            if self.backend == 'monitoring':
+                self._monitor_frame(frame)
+            else:
+                localtrace = self.globaltrace(frame, 'call', None)
+                if localtrace is not None:
+                    frame.f_trace = localtrace
+
+    def _uninstall(self, all_threads=False):
+        self._installed = False
+        if self._recorder is not None:
+            self._recorder.flush()
+        if self.backend == 'sink':
+            self._sink_stop()
+        elif self.backend in ('profile', 'callgraph'):
+            sys.setprofile(None)
+            if all_threads and _HAVE_ALL_THREADS:
+                threading.setprofile_all_threads(None)
+            else:
+                threading.setprofile(None)
+            if self._callgraph is not None:
+                self._callgraph.close()
+        elif self.backend == 'monitoring':
+            self._monitoring_stop()
+        else:
+            sys.settrace(None)
+            if all_threads and _HAVE_ALL_THREADS:
+                threading.settrace_all_threads(None)
+            else:
                 threading.settrace(None)
+            if all_threads:
+                for frame in self._running_frames():
+                    frame.f_trace = None
+        if self._saved_env is not None:
+            for name, value in self._saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            self._saved_env = None
+        if self._writer is not None:
+            self._writer.flush()
+            if self._writer.dropped:
+                print("trace: %d rounds dropped, the render queue was full"
+                      % self._writer.dropped, file=sys.stderr)
+        if self.budget is not None:
+            # The counts add up over start()/stop() toggles: list only
+            # the sites that lost rounds since the last stop
+            reported = self._budget_reported
+            suppressed = [(site, lost, calls) for site, lost, calls
+                          in self.budget.suppressed()
+                          if reported.get(site) != lost]
+            reported.update((site, lost) for site, lost, _ in suppressed)
+            if suppressed:
+                print("trace: rounds suppressed by the budget, per output "
+                      "call site:", file=sys.stderr)
+                for (filename, lineno), lost, calls in suppressed:
+                    print("  %s:%d: %d of %d" % (filename, lineno, lost,
+                                                  calls), file=sys.stderr)
+
+    def _follow_children(self):
+        if not self._fork_hooked and hasattr(os, 'register_at_fork'):
+            self._fork_hooked = True
+            os.register_at_fork(before=self._recorder.flush,
+                                after_in_child=self._after_fork)
+        if _CHILD_ENV in os.environ:
+            # A traced child: its children inherit the environment
+            return
+        site_dir = tempfile.mkdtemp(prefix='pylogtrace-')
+        with open(os.path.join(site_dir, 'sitecustomize.py'), 'w') as f:
+            f.write(_CHILD_SITECUSTOMIZE
+                    % os.path.dirname(os.path.abspath(__file__)))
+        atexit.register(shutil.rmtree, site_dir, True)
+        self._saved_env = {name: os.environ.get(name)
+                           for name in ('PYTHONPATH', _CHILD_ENV)}
+        pythonpath = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = (site_dir + os.pathsep + pythonpath
+                                    if pythonpath else site_dir)
+        os.environ[_CHILD_ENV] = json.dumps(self._child_config)
+
+    def _after_fork(self):
+        if not self._installed:
+            # The fork hook stays registered after stop(); a child
+            # forked then is not traced and records nothing
+            return
+        # The parent flushed before forking, so the inherited recorder
+        # has nothing of the child's to write
+        self._recorder = _RoundRecorder('%s.%d' % (self._record_base,
+                                                   os.getpid()))
+        self._recorder.autoflush = True
+        self._saved_env = None
 
     def runfunc(*args, **kw):
         if len(args) >= 2:
@@ -505,55 +2605,133 @@ class Trace:
 
         result = None
         if not self.donothing:
-            sys.settrace(self.globaltrace)
+            if self.backend == 'settrace':
+                sys.settrace(self.globaltrace)
+            else:
+                self._install()
         try:
             result = func(*args, **kw)
         finally:
             if not self.donothing:
-                sys.settrace(None)
+                if self.backend == 'settrace':
+                    sys.settrace(None)
+                else:
+                    if self.backend in ('profile', 'callgraph'):
+                        sys.setprofile(None)
+                    elif self.backend == 'monitoring':
+                        sys.monitoring.set_events(self._monitor_tool, 0)
+                    self._uninstall()
         return result
     runfunc.__text_signature__ = '($self, func, /, *args, **kw)'
 
+    # Tracing a region of a program that runs untraced otherwise:
+    #
+    #     tracer = Trace(count=0, trace=1)
+    #     with tracer:
+    #         suspicious()
+    #
+    # or @tracer.traced on a function, or tracer.toggle_on_signals() in
+    # a daemon, then kill -USR1 <pid> to start and kill -USR2 <pid> to
+    # stop.  While stopped no hook is installed at all.
+
+    def start(self):
+        """Start tracing in all threads; return false if it already was.
+
+        Before Python 3.12, threads that are already running other than
+        the calling one are not traced.  The frames that are already
+        running are traced from their next line on.
+        """
+        if self._started or self.donothing:
+            return False
+        self._started = True
+        self._install(all_threads=True)
+        return True
+
+    def stop(self):
+        """Stop tracing in all threads; return false if it was not on.
+
+        Before Python 3.12, threads started while tracing was on keep
+        their hooks until they end.
+        """
+        if not self._started:
+            return False
+        self._started = False
+        # Off here, so that _uninstall() itself is not traced
+        if self.backend in ('profile', 'callgraph'):
+            sys.setprofile(None)
+        elif self.backend == 'monitoring':
+            sys.monitoring.set_events(self._monitor_tool, 0)
+        elif self.backend != 'sink':
+            sys.settrace(None)
+        self._uninstall(all_threads=True)
+        return True
+
+    def __enter__(self):
+        self._entered.append(self.start())
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._entered.pop():
+            self.stop()
+
+    def traced(self, func):
+        """Decorator: trace the calls of func."""
+        @functools.wraps(func)
+        def traced(*args, **kw):
+            with self:
+                return func(*args, **kw)
+        # Left out of the rounds, see _filter_stack()
+        self._wrapper_codes.add(traced.__code__)
+        return traced
+
+    def toggle_on_signals(self, on=None, off=None):
+        """Start tracing on signal on (SIGUSR1) and stop on signal off
+        (SIGUSR2).  Must be called from the main thread."""
+        import signal
+        if on is None:
+            on = signal.SIGUSR1
+        if off is None:
+            off = signal.SIGUSR2
+        signal.signal(on, lambda signum, frame: self.start())
+        signal.signal(off, lambda signum, frame: self.stop())
+
     def file_module_function_of(self, frame):
+        """Return (filename, modulename, funcname) of frame's code.
+
+        Methods are named "Class.method".  The answer is kept per code
+        object in an LRU cache of _caller_cache_size entries.
+        """
         code = frame.f_code
+        cache = self._caller_cache
+        try:
+            func = cache[code]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(code)
+            return func
+
         filename = code.co_filename
         if filename:
             modulename = _modname(filename)
         else:
             modulename = None
 
-        funcname = code.co_name
-        clsname = None
-        if code in self._caller_cache:
-            if self._caller_cache[code] is not None:
-                clsname = self._caller_cache[code]
+        qualname = getattr(code, 'co_qualname', None)
+        if qualname is not None:
+            # Python 3.11+.  Functions nested in functions are named
+            # from their own scope on: "f.<locals>.C.m" is "C.m"
+            funcname = qualname.rpartition('<locals>.')[2]
         else:
-            self._caller_cache[code] = None
-            ## use of gc.get_referrers() was suggested by Michael Hudson
-            # all functions which refer to this code object
-            funcs = [f for f in gc.get_referrers(code)
-                         if inspect.isfunction(f)]
-            # require len(func) == 1 to avoid ambiguity caused by calls to
-            # new.function(): "In the face of ambiguity, refuse the
-            # temptation to guess."
-            if len(funcs) == 1:
-                dicts = [d for d in gc.get_referrers(funcs[0])
-                             if isinstance(d, dict)]
-                if len(dicts) == 1:
-                    classes = [c for c in gc.get_referrers(dicts[0])
-                                   if hasattr(c, "__bases__")]
-                    if len(classes) == 1:
-                        # ditto for new.classobj()
-                        clsname = classes[0].__name__
-                        # cache the result - assumption is that new.* is
-                        # not called later to disturb this relationship
-                        # _caller_cache could be flushed if functions in
-                        # the new module get called.
-                        self._caller_cache[code] = clsname
-        if clsname is not None:
-            funcname = "%s.%s" % (clsname, funcname)
-
-        return filename, modulename, funcname
+            funcname = code.co_name
+            clsname = _method_class(frame)
+            if clsname is not None:
+                funcname = "%s.%s" % (clsname, funcname)
+
+        func = cache[code] = filename, modulename, funcname
+        if len(cache) > self._caller_cache_size:
+            cache.popitem(last=False)
+        return func
 
     def globaltrace_trackcallers(self, frame, why, arg):
         """Handler for call events.
@@ -578,93 +2756,173 @@ class Trace:
     def globaltrace_lt(self, frame, why, arg):
         """Handler for call events.
 
-        If the code block being entered is to be ignored, returns `None',
-        else returns self.localtrace.
+        If the code block being entered is to be ignored, or has no output
+        call to report while tracing, returns `None', else returns
+        self.localtrace, or the code's counting tracer in the --count
+        modes.
         """
         if why == 'call':
             code = frame.f_code
-            filename = frame.f_globals.get('__file__', None)
-            if filename:
-
-
-                #hole: less log: #1
-                #if filename in self.f_dM:
-                #    if self.f_dM[filename] > 500:
-                #        return
-                #    else:
-                #        #print('lalaM: ' + repr(self.f_dM))
-                #        self.f_dM[filename]+=1
-                #else:
-                #    #print('lala1: ' + repr(self.f_dM))
-                #    self.f_dM[filename] = 1
-
-                # [disabled] can simply patch logging:
-                #if 'logging' in filename:
-                #    if self.pre_loggingM is None:
-                #        return
-                #    filename = self.pre_loggingM
-                #    self.pre_loggingM = None
-                #else:
-                #    self.pre_loggingM = filename
-                #    return 
-
-
-                # XXX _modname() doesn't work right for packages, so
-                # the ignore support won't work right for packages
-                modulename = _modname(filename)
-                if modulename is not None:
-                    ignore_it = self.ignore.names(filename, modulename)
-                    if not ignore_it:
-                        if self.trace:
-
-                            # hole: Note this one is early code, not expect to use. Use bottom only. 
-                            ccn = code.co_name
-                            # When modify, be careful it `return self.localtrace` unlike another one which only `return`
-                            if ('print(' not in ccn) and ('.write(' not in ccn): 
-                                #if 'print(' not in code.co_name:
-                                return self.localtrace
-                            if '.write(' not in debugL:
-                                if not self.print_regex.search(debugL):
-                                    return self.localtrace
-                                elif self.cprint_regex.search(debugL):
-                                    return self.localtrace
-                                elif self.logging_regex == filename:
-                                    return self.localtrace
-                            elif self.logging_regex == filename:
-                                return self.localtrace
-
-                            #print(''.join(['\n\x1b[7;36m[holeL] name: ', repr(name), ' lvl: ', repr(level), ' fn: \x1b[0m\x1b[K\x1b[17;36m', repr(fn), '\x1b[0m\x1b[K\x1b[7;36m lno: ', repr(lno), ' msg: ', repr(msg), ' args: ', repr(args), ' exc_info: ', repr(exc_info), ' func: ', repr(func), ' sinfo: ', repr(sinfo), '\x1b[0m\x1b[K' ]))
-
-                            print()
-                            if self.start_time:
-                                print('\x1b[7;36mholeC %.2f' % self.t, end=' ')
-
-                            print(("\x1b[7;36m[holeM] --- modulename: %s, fn: \x1b[0m\x1b[K\x1b[17;36m%s\x1b[0m\x1b[K\x1b[7;36m, funcname: %s\x1b[0m\x1b[K"
-                                   % (modulename, filename, code.co_name)))
+            try:
+                return self._code_traces[code]
+            except KeyError:
+                pass
+            localtrace = self._code_traces[code] = self._code_trace(frame)
+            return localtrace
+
+    def _code_trace(self, frame):
+        """Return what globaltrace_lt returns for frame's code object.
+
+        globaltrace_lt caches the answer per code object, so this runs
+        once per code object instead of on every call.
+        """
+        code = frame.f_code
+        if code.co_filename == self.trace_regex:
+            # Our own calls, e.g. __exit__() and stop() while tracing
+            return None
+        filename = frame.f_globals.get('__file__', None)
+        if filename:
+
+
+            #hole: less log: #1, see SiteBudget
+            # [disabled] can simply patch logging:
+            #if 'logging' in filename:
+            #    if self.pre_loggingM is None:
+            #        return
+            #    filename = self.pre_loggingM
+            #    self.pre_loggingM = None
+            #else:
+            #    self.pre_loggingM = filename
+            #    return 
+
+
+            # XXX _modname() doesn't work right for packages, so
+            # the ignore support won't work right for packages
+            modulename = _modname(filename)
+            if modulename is not None:
+                ignore_it = self.ignore.names(filename, modulename)
+                if not ignore_it:
+                    if not self._counting:
+                        # hole: only wake the local tracer in code
+                        # that can print something at all
+                        if not self._output_sites(code):
+                            return None
                         return self.localtrace
-            else:
-                return None
+                    return self._line_tracer(code)
+        else:
+            return None
+
+    def _line_tracer(self, code):
+        """Return the local trace function of code in the --count modes.
+
+        It is made once per code object and counts into that code's
+        array, so a line event costs an index and an add instead of
+        building and hashing a (filename, lineno) key.
+
+        With first_hit, once every line of code has run the frames of
+        code stop getting line events, and None is returned for the
+        code so that its new frames are not traced at all.
+        """
+        try:
+            return self._line_tracers[code]
+        except KeyError:
+            pass
+        base, counts = self._line_counter(code)
+        if self.first_hit:
+            return self._first_hit_tracer(code, base, counts)
+        trace_line = None
+        if self.trace:
+            trace_line = self._trace_line
+        count_line = self._count_line
+
+        def localtrace(frame, why, arg):
+            if why == "line":
+                index = frame.f_lineno - base
+                if 0 <= index < len(counts):
+                    counts[index] += 1
+                else:
+                    count_line(frame)
+                if trace_line is not None:
+                    trace_line(frame)
+            return localtrace
+
+        self._line_tracers[code] = localtrace
+        return localtrace
+
+    def _first_hit_tracer(self, code, base, counts):
+        tracers = self._line_tracers
+        code_traces = self._code_traces
+        pending = _traced_linenos(code)
+
+        def localtrace(frame, why, arg):
+            if why == "line":
+                lineno = frame.f_lineno
+                index = lineno - base
+                if 0 <= index < len(counts):
+                    if not counts[index]:
+                        counts[index] = 1
+                        pending.discard(lineno)
+                        if not pending:
+                            tracers[code] = code_traces[code] = None
+                else:
+                    self.counts[code.co_filename, lineno] = 1
+                if not pending:
+                    # Other frames of code find out on their next line
+                    frame.f_trace_lines = False
+            return localtrace
+
+        tracers[code] = localtrace
+        return localtrace
+
+    def _line_counter(self, code):
+        """Return (base, counts): the count of line lineno of code is
+        counts[lineno - base]."""
+        try:
+            return self._line_counts[code]
+        except KeyError:
+            pass
+        linenos = [lineno for _, lineno in dis.findlinestarts(code)
+                   if lineno is not None]
+        base = min(linenos, default=code.co_firstlineno)
+        size = max(linenos, default=base) - base + 1
+        counter = self._line_counts[code] = base, array('Q', bytes(8 * size))
+        return counter
+
+    def _count_line(self, frame):
+        key = frame.f_code.co_filename, frame.f_lineno
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def _count_code_line(self, frame):
+        base, counts = self._line_counter(frame.f_code)
+        index = frame.f_lineno - base
+        if 0 <= index < len(counts):
+            counts[index] += 1
+        else:
+            self._count_line(frame)
 
     def localtrace_trace_and_count(self, frame, why, arg):
+        # Like the local tracers of _line_tracer(), one call at a time
         if why == "line":
-            # record the file name and line number of every trace
-            filename = frame.f_code.co_filename
-            lineno = frame.f_lineno
-            key = filename, lineno
-            self.counts[key] = self.counts.get(key, 0) + 1
+            self._count_code_line(frame)
+            self._trace_line(frame)
+        return self.localtrace
 
-            if self.start_time:
-                self.t = time() - self.start_time
-                #print('holeT1 %.2f' % (_time() - self.start_time), end=' ')
-            bname = os.path.basename(filename)
+    def _trace_line(self, frame):
+        filename = frame.f_code.co_filename
+        lineno = frame.f_lineno
+        if self.start_time:
+            self.t = _time() - self.start_time
+            #print('holeT1 %.2f' % (_time() - self.start_time), end=' ')
+        bname = os.path.basename(filename)
 
-            # hole:
-            if self.start_time:
-                print('holeC2 %.2f' % self.t, end=' ')
+        # hole:
+        if self.start_time:
+            print('holeC2 %.2f' % self.t, end=' ')
 
-            print("[holeB] %s(%d): %s" % (bname, lineno,
-                                  linecache.getline(filename, lineno)), end='')
-        return self.localtrace
+        if self.stats is not None:
+            self.stats.count('source line lookups (line trace)')
+        print("[holeB] %s(%d): %s" % (bname, lineno,
+                              _source_lines.getline(filename, lineno)), end='')
 
     def localtrace_trace(self, frame, why, arg):
         if why == "line":
@@ -683,234 +2941,393 @@ class Trace:
             #    self.pre_logging = filename
             #    return 
 
-            #if filename in self.f_d:
-            #    if self.f_d[filename] > 500:
-            #        return
-            #    else:
-            #        #print('lalaM: ' + repr(self.f_d))
-            #        self.f_d[filename]+=1
-            #else:
-            #    #print('lala1: ' + repr(self.f_d))
-            #    self.f_d[filename] = 1
-
 
             lineno = frame.f_lineno
 
-            if self.start_time:
-                self.t = _time() - self.start_time
-                #print('holeT2 %.2f' % (_time() - self.start_time), end=' ')
-            #bname = filename #hole #os.path.basename(filename)
-
             # hole:
-            debugL = linecache.getline(filename, lineno) 
-            if '.write(' not in debugL:
-                if not self.print_regex.search(debugL):
-                    return
-                elif self.cprint_regex.search(debugL):
-                    return
-                #elif self.logging_regex == filename: # Assume we patched logging module already with `print(''.join(['\n\x1b[7;36m[holeL] name: ', repr(name), ' lvl: ', repr(level), ' fn: \x1b[0m\x1b[K\x1b[17;36m', repr(fn), '\x1b[0m\x1b[K\x1b[7;36m lno: ', repr(lno), ' msg: ', repr(msg), ' args: ', repr(args), ' exc_info: ', repr(exc_info), ' func: ', repr(func), ' sinfo: ', repr(sinfo), '\x1b[0m\x1b[K' ]))` in `makeRecord()` of /usr/lib/python3.8/logging/__ini__.py
-                #    return
-            #elif self.logging_regex == filename:
-            #    return
-
-            ##print(''.join(['\n\x1b[7;36m[holeL] name: ', repr(name), ' lvl: ', repr(level), ' fn: \x1b[0m\x1b[K\x1b[17;36m', repr(fn), '\x1b[0m\x1b[K\x1b[7;36m lno: ', repr(lno), ' msg: ', repr(msg), ' args: ', repr(args), ' exc_info: ', repr(exc_info), ' func: ', repr(func), ' sinfo: ', repr(sinfo), '\x1b[0m\x1b[K' ]))
-            print()
-            if self.start_time:
-                cprint('\x1b[6;42m%s\t\t\t\t\t%.2fs' % (Fore.BLACK, self.t), end='\n')
-                #print('\x1b[7;39m\t\t\t\t\tTime: %.2f' % self.t, end='\n')
-            #if self.logging_regex == filename:
-            #    print("\x1b[7;39m[Curr]\x1b[0m\x1b[K \x1b[17;36m%s\x1b[0m\x1b[K \x1b[7;36m(%d): %s\x1b[0m\x1b[K" % (filename, lineno,
-            #                      linecache.getline(filename, lineno)), end='')
-
-            #print('f: ' + repr(filename))
-            #print(dir(frame.f_code))
-            #['__class__', '__delattr__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__', '__gt__', '__hash__', '__init__', '__init_subclass__', '__le__', '__lt__', '__ne__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', 'co_argcount', 'co_cellvars', 'co_code', 'co_consts', 'co_filename', 'co_firstlineno', 'co_flags', 'co_freevars', 'co_kwonlyargcount', 'co_lnotab', 'co_name', 'co_names', 'co_nlocals', 'co_posonlyargcount', 'co_stacksize', 'co_varnames', 'replace']
-
-            #print(frame.f_code.co_names) #if logging: ('print', 'join', 'repr', '_logRecordFactory', '__dict__', 'KeyError')
-            #print(frame.f_code.co_name) #if logging: makeRecord
-            #print(dir(frame))
-            #print(frame.f_back.f_back.f_lineno)
-            ist = inspect.stack()
-            come_middle_stack = False
-            #first_stack = True
-            skip_middle_logging = False
-            self.curr_ist = []
-            self.curr_full_index = 0
-
-            skip_log_trace = True #False if you don't want skip any useless log
-
-            for ei, s in enumerate(ist):
-
-                if skip_log_trace:
-                    if s.filename == self.trace_regex:
-                        if not come_middle_stack:
-                            continue
-                        else:
-                            break
-                    elif (s.filename in self.log_tb_file):
-                        if come_middle_stack:
-                            skip_middle_logging = True
-                        continue
-                    else:
-                        come_middle_stack = True
-                        if skip_middle_logging:
-                            skip_middle_logging = False
-
-                self.curr_ist.append((s.filename, s.lineno))
-
-
-            #2nd
-            come_middle_stack = False
-            skip_middle_logging = False
-            skip_index = 0 #should do inside 2nd loop, not 1st loop bcoz used when looping/increment together with ei
-
-            printed_same = False
-            curr_real_index = 0
-
-            for ei, s in enumerate(ist):
-
-                #print(dir(s)) #['__add__', '__class__', '__contains__', '__delattr__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__', '__getitem__', '__getnewargs__', '__gt__', '__hash__', '__init__', '__init_subclass__', '__iter__', '__le__', '__len__', '__lt__', '__module__', '__mul__', '__ne__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__rmul__', '__setattr__', '__sizeof__', '__slots__', '__str__', '__subclasshook__', '_asdict', '_field_defaults', '_fields', '_fields_defaults', '_make', '_replace', 'code_context', 'count', 'filename', 'frame', 'function', 'index', 'lineno']
-                #print('hole sf: ' + s.filename)
-
-                if skip_log_trace:
-                    if s.filename == self.trace_regex: # Don't print trace.py and upper
-                        skip_index+=1
-                        if not come_middle_stack:
-                            continue
-                        else:
-                            break
-                    elif (s.filename in self.log_tb_file):
-                        skip_index+=1
-                        if come_middle_stack:
-                            skip_middle_logging = True
-                            #continue 
-                        #else: # Skip /usr/lib/python3.8/logging/__init__.py, only if not go middle yet
+            if lineno not in self._output_sites(frame.f_code):
+                return
+            early = self._early_events.get(frame.f_code)
+            if early and frame.f_lasti in early:
+                # The first line of a split call, before its arguments
+                return self.localtrace
+            self._log_round(frame)
+
+        return self.localtrace
+
+    def _output_sites(self, code):
+        """Return the set of lines of code that call print() or .write().
+
+        The source of each file is parsed once and the result is cached
+        per code object, so the per-line check is a set lookup.
+        """
+        try:
+            return self._code_sites[code]
+        except KeyError:
+            pass
+        filename = code.co_filename
+        if filename == self.trace_regex:
+            # Never report the tracer's own output calls
+            file_sites = set()
+        else:
+            file_sites = self._file_sites.get(filename)
+            if file_sites is None:
+                if self.stats is not None:
+                    start = _perf_counter()
+                file_sites = _find_output_linenos(filename)
+                self._file_sites[filename] = file_sites
+                if self.stats is not None:
+                    self.stats.add_time('source scans',
+                                        _perf_counter() - start)
+        if file_sites:
+            starts = list(dis.findlinestarts(code))
+            sites = frozenset(lineno for _, lineno in starts
+                              if lineno in file_sites)
+            early = _early_call_events(starts, file_sites) if sites else None
+            if early:
+                self._early_events[code] = early
+        else:
+            sites = frozenset()
+        self._code_sites[code] = sites
+        return sites
+
+    def _filter_stack(self, stack):
+        """Drop the tracer's own frames and the logging/traceback frames.
+
+        Returns the kept frames as (filename, lineno) pairs, innermost
+        first, and the set of indexes in that list which directly follow
+        a run of skipped logging frames.
+        """
+        come_middle_stack = False
+        skip_middle_logging = False
+        kept = []
+        skipped_at = set()
+
+        skip_log_trace = True #False if you don't want skip any useless log
+
+        for code, lineno in stack:
+            filename = code.co_filename
+
+            if code in self._wrapper_codes:
+                # A traced() wrapper: the caller's frames are kept
+                continue
+            if skip_log_trace:
+                if filename == self.trace_regex: # Don't print trace.py and upper
+                    if not come_middle_stack:
                         continue
                     else:
-                        come_middle_stack = True
-                        if skip_middle_logging:
-                            #print(s.filename)
-                            print('\x1b[7;39m[Skipped logging ...]\x1b[0m\x1b[K')
-                            skip_middle_logging = False
-
-
-                #'''
-                break_remains = False
-                curr_real_index+=1
-
-                debug = False
-                #debug_f= '/usr/lib/python3/dist-packages/pip/_internal/commands/install.py'
-                #debug_f = '/usr/lib/python3/dist-packages/pip/_internal/cli/base_command.py'
-                #debug_f = '/usr/lib/python3/dist-packages/pip/_internal/req/req_install.py'
-                #debug_f = '/home/xiaobai/.local/lib/python3.8/site-packages/you_get/extractor.py'
-                # Note 1: Possible multiple print() get combine and so only print top print() code
-
-                if not printed_same:
-
-                    for pi, pist in enumerate(self.prev_ist):
-
-                        #if s.filename == debug_f:
-                        #    debug = True
-                        if debug:
-                            print(s.filename + ' #VS F# ' + pist[0])
-                            print(str(s.lineno) + ' #VS L# ' + str(pist[1]))
-
-                        if s.filename == pist[0] and s.lineno == pist[1] :
-
-                            if debug:
-                                print('same[1] pi: ' + str(pi) )
-                                print('before ist: ' + repr(self.curr_ist))
-
-                            iist = self.curr_ist[curr_real_index:]
-
-                            if debug:
-                                print('after iist: ' + repr(iist))
-                                print('before plist: ' + repr(self.prev_ist))
-
-                            pist = self.prev_ist[pi+1:]
-
-                            if debug:
-                                print('after plist: ' + repr(pist))
-
-                            ist_sz = len(iist)
-                            pist_sz = len(pist)
-                            if ist_sz >= pist_sz: # must >= to follow pist's pi2 below
-                                all_equal = True
-                                for pi2, pist2 in enumerate(pist):
-                                    if (pist2[0] != iist[pi2][0]):
-                                        if debug:
-                                            print('pist2[0] != self.iist[pi2][0] filename:' + repr(pist2[0]) + ' ## ' + repr( iist[pi2][0]) )
-                                        all_equal = False
-                                        break
-                                    elif pist2[1] != iist[pi2][1]:
-                                        if debug:
-                                            print('pist2[1] != self.iist[pi2][1] lineno:' + repr(pist2[1]) + ' ## ' + repr( iist[pi2][1]) )
-                                        all_equal = False
-                                        break
-
-                                if debug:
-                                    print('all equal? ' + str(all_equal))
-
-                                if all_equal:
-                                    prev_break_at = pi + 1
-                                    #print('same all: ' + repr(prev_break_at))
-                                    prev_total = len(self.prev_ist)
-                                    if prev_break_at == prev_total:
-                                        print("\x1b[3;39m\x1b[6;44m #" + str(ei - skip_index + 1) + " [ EQU ] == Previous #" + str(prev_break_at) + " \x1b[0m\x1b[K", end='\n')
-                                    else: 
-                                        print("\x1b[3;39m\x1b[6;44m #" + str(ei - skip_index + 1) + " [ EQU ] == Previous #" + str(prev_break_at) + ' - #' + str(prev_total) + " \x1b[0m\x1b[K", end='\n')
-                                    break_remains = True
-                                    printed_same = True
-                                    curr_break_at = ei - skip_index + 1
-                                    break
-                            else:
-                                pass #print('diff size: ' + str(ist_sz) + ' ## ' + str(pist_sz))
-                        else:
-                            pass #print('NOT match: ' + s.filename + ' VS '  +  pist[0] + ' ## ' + str(s.lineno) +' VS2: ' + str(pist[1]) )
-                    #'''
-
-                #if first_stack:
-                #    first_stack = False
-
-                if printed_same:
-                    cprint( ''.join([ '\x1b[0m\x1b[K\x1b[6;44m', Fore.LIGHTWHITE_EX , ' #', str(ei - skip_index + 1), ' [ EQU ] ' ]), attrs=BOLD_ONLY, end='')
-                    #tag = '\x1b[7;39m#' + str(ei - skip_index + 1) + ' [Equal] '
-                else:
-                    #, Fore.LIGHTRED_EX
-                    cprint( ''.join([ '\x1b[0m\x1b[K\x1b[6;42m', Fore.BLACK, ' #', str(ei - skip_index + 1), ' [ NEW ] ' ]), attrs=BOLD_ONLY, end='')
-                    #tag = '\x1b[5m\x1b[6;32m#' + str(ei - skip_index + 1) + ' [ New ]'
-                    
-                # Possible sys.stderr.write output on top first instead of bottom of round, so put flush=True here
-                if s.code_context: # possible None for top 2 func, at `shutil.make_archive(epub_name_with_path, 'zip', self.EPUB_DIR)` which involved shutil.py and zipfile.py
-                    cprint("\x1b[0m\x1b[K \x1b[17;36m%s\x1b[0m\x1b[K\n       \x1b[7;36m(%d): %s %s\x1b[0m\x1b[K" % (s.filename, s.lineno,
-                                Fore.LIGHTWHITE_EX, '\n'.join(s.code_context)), end='\n', flush=True)
+                        break
+                elif (filename in self.log_tb_file):
+                    if come_middle_stack:
+                        skip_middle_logging = True
+                    #else: # Skip /usr/lib/python3.8/logging/__init__.py, only if not go middle yet
+                    continue
                 else:
-                    cprint("\x1b[0m\x1b[K \x1b[17;36m%s\x1b[0m\x1b[K\n       \x1b[7;36m(%d): %s %s\x1b[0m\x1b[K" % (s.filename, s.lineno,
-                                Fore.LIGHTWHITE_EX, '<None>'), end='\n', flush=True)
+                    come_middle_stack = True
+                    if skip_middle_logging:
+                        skipped_at.add(len(kept))
+                        skip_middle_logging = False
+
+            kept.append((filename, lineno))
+        return kept, skipped_at
+
+    def _log_round(self, frame):
+        """Print or record the stack of the output call made in frame.
+
+        Runs in whichever thread made the call.  Each thread's rounds
+        are compared with that thread's previous rounds only, and those
+        of threads other than the main one are tagged with the thread
+        name; no state is shared between threads here.  With
+        asyncio_tasks the same goes for the rounds of each task.
+        """
+        if self._writer is not None and self._writer.in_writer():
+            return
+        stats = self.stats
+        if stats is not None:
+            stats.count('output calls')
+        if self.budget is not None:
+            # Before the stack is walked: an over-budget site costs a
+            # few frames at most
+            if not self.budget.admit(self._output_site(frame)):
+                if stats is not None:
+                    stats.count('rounds over budget')
+                return
+        ##print(''.join(['\n\x1b[7;36m[holeL] name: ', repr(name), ' lvl: ', repr(level), ' fn: \x1b[0m\x1b[K\x1b[17;36m', repr(fn), '\x1b[0m\x1b[K\x1b[7;36m lno: ', repr(lno), ' msg: ', repr(msg), ' args: ', repr(args), ' exc_info: ', repr(exc_info), ' func: ', repr(func), ' sinfo: ', repr(sinfo), '\x1b[0m\x1b[K' ]))
+        #if self.logging_regex == filename:
+        #    print("\x1b[7;39m[Curr]\x1b[0m\x1b[K \x1b[17;36m%s\x1b[0m\x1b[K \x1b[7;36m(%d): %s\x1b[0m\x1b[K" % (filename, lineno,
+        #                      linecache.getline(filename, lineno)), end='')
+
+        #print('f: ' + repr(filename))
+        #print(dir(frame.f_code))
+        #['__class__', '__delattr__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__', '__getattribute__', '__gt__', '__hash__', '__init__', '__init_subclass__', '__le__', '__lt__', '__ne__', '__new__', '__reduce__', '__reduce_ex__', '__repr__', '__setattr__', '__sizeof__', '__str__', '__subclasshook__', 'co_argcount', 'co_cellvars', 'co_code', 'co_consts', 'co_filename', 'co_firstlineno', 'co_flags', 'co_freevars', 'co_kwonlyargcount', 'co_lnotab', 'co_name', 'co_names', 'co_nlocals', 'co_posonlyargcount', 'co_stacksize', 'co_varnames', 'replace']
+
+        #print(frame.f_code.co_names) #if logging: ('print', 'join', 'repr', '_logRecordFactory', '__dict__', 'KeyError')
+        #print(frame.f_code.co_name) #if logging: makeRecord
+        #print(dir(frame))
+        #print(frame.f_back.f_back.f_lineno)
+        # hole: raw frame walk, see _capture_stack()
+        if stats is not None:
+            start = _perf_counter()
+        task = _current_task() if self.asyncio_tasks else None
+        if task is None:
+            stack = _capture_stack(frame)
+        else:
+            stack = _capture_task_stack(frame, task)
+        if stats is not None:
+            now = _perf_counter()
+            stats.add_time('stack walks', now - start)
+            stats.count('frames walked', len(stack))
+            start = now
+        frames, skipped_at = self._filter_stack(stack)
+        if stats is not None:
+            stats.add_time('stack filtering', _perf_counter() - start)
+        if self._recorder is not None:
+            self._recorder.record(frames, skipped_at)
+            return
+        t = _time() - self.start_time if self.start_time else None
+        # The Thread object rather than its ident, which a later thread
+        # may get again: the thread's state goes away with the thread
+        key = thread = threading.current_thread()
+        tags = []
+        if thread is not threading.main_thread():
+            tags.append('thread %s' % thread.name)
+        if task is not None:
+            key = task
+            tags.append('task %s' % task.get_name())
+        tag = ' '.join(tags) or None
+        if self._writer is not None:
+            self._writer.submit(frames, skipped_at, t, tag, key)
+        else:
+            self._printer.print_round(frames, skipped_at, t, tag, key)
 
+    def _output_site(self, frame):
+        """Return the (filename, lineno) that asked for output in frame.
 
-            #for cr in self.curr_ist:
-            #    print('curr: ' + repr(cr))
-            self.prev_ist = copy.deepcopy(self.curr_ist)
-            self.prev_full_index = self.curr_full_index
+        That is the first frame that is neither the tracer's nor in the
+        logging/traceback modules, so that all the output of a logging
+        call counts for the line that made it.
+        """
+        site = frame
+        while site is not None:
+            filename = site.f_code.co_filename
+            if (filename != self.trace_regex
+                    and filename not in self.log_tb_file):
+                return filename, site.f_lineno
+            site = site.f_back
+        return frame.f_code.co_filename, frame.f_lineno
+
+    # sys.monitoring backend of the log-trace mode.  Instead of a line
+    # event for every executed line of every frame, each code object
+    # is looked at once on PY_START, and only the code objects that are
+    # not ignored get LINE events.  Each line is then checked once: if
+    # it can never produce output its location is disabled, so the
+    # interpreter stops reporting it.  sys.monitoring events fire in
+    # every thread, so no threading hook is needed.
+    #
+    # The first-hit count uses the same hooks as a coverage tool: a
+    # line is recorded and disabled on its first LINE event.
+
+    def _monitoring_start(self, hook_running=False):
+        mon = sys.monitoring
+        tool = self._monitor_tool
+        try:
+            mon.use_tool_id(tool, 'pylogtrace')
+        except ValueError:
+            return False
+        mon.register_callback(tool, mon.events.PY_START,
+                              self._monitor_py_start)
+        line = self._monitor_first_line if self.first_hit else self._monitor_line
+        if self.stats is not None:
+            line = self.stats.counted_line(line)
+        mon.register_callback(tool, mon.events.LINE, line)
+        if hook_running:
+            # Before PY_START is on, as in _install()
+            self._hook_running_frames()
+        mon.set_events(tool, mon.events.PY_START)
+        return True
+
+    def _monitoring_stop(self):
+        mon = sys.monitoring
+        tool = self._monitor_tool
+        mon.set_events(tool, 0)
+        for code in self._monitored:
+            mon.set_local_events(tool, code, 0)
+        self._monitored = []
+        mon.register_callback(tool, mon.events.PY_START, None)
+        mon.register_callback(tool, mon.events.LINE, None)
+        mon.free_tool_id(tool)
+        # Give locations disabled by this run a chance in the next one
+        mon.restart_events()
+
+    def _monitor_py_start(self, code, instruction_offset):
+        # The callback runs on top of the frame that is starting
+        self._monitor_frame(sys._getframe(1))
+        return sys.monitoring.DISABLE
+
+    def _monitor_frame(self, frame):
+        if self.globaltrace(frame, 'call', None) is not None:
+            sys.monitoring.set_local_events(self._monitor_tool, frame.f_code,
+                                            sys.monitoring.events.LINE)
+            self._monitored.append(frame.f_code)
+
+    def _monitor_line(self, code, line_number):
+        if line_number not in self._output_sites(code):
+            return sys.monitoring.DISABLE
+        frame = sys._getframe(1)
+        early = self._early_events.get(code)
+        if early and frame.f_lasti in early:
+            # Events are disabled per instruction: the event just before
+            # the call still fires
+            return sys.monitoring.DISABLE
+        self._log_round(frame)
+
+    def _monitor_first_line(self, code, line_number):
+        base, counts = self._line_counter(code)
+        index = line_number - base
+        if 0 <= index < len(counts):
+            counts[index] = 1
+        else:
+            self.counts[code.co_filename, line_number] = 1
+        return sys.monitoring.DISABLE
+
+    # Output-sink backend of the log-trace mode.  No line is traced:
+    # sys.stdout/sys.stderr, builtins.print and logging.Handler.handle
+    # are wrapped, and a round is printed when one of them is called.
+    # The outermost wrapped call of a thread makes the round; the calls
+    # it makes itself (print -> sys.stdout.write, handle -> emit ->
+    # stream.write) and the round's own printing go straight through.
+
+    def _sink_start(self):
+        self._sink_saved = (sys.stdout, sys.stderr, builtins.print,
+                            logging.Handler.handle)
+        stdout, stderr, orig_print, orig_handle = self._sink_saved
+        sink_call = self._sink_call
+
+        def print(*args, **kw):
+            return sink_call(sys._getframe(1), orig_print, args, kw, 'print')
+
+        def handle(handler, record):
+            return sink_call(sys._getframe(1), orig_handle, (handler, record),
+                             {}, 'record')
+
+        builtins.print = print
+        logging.Handler.handle = handle
+        sys.stdout = _SinkStream(stdout, sink_call)
+        sys.stderr = _SinkStream(stderr, sink_call)
+
+    def _sink_stop(self):
+        stdout, stderr, orig_print, orig_handle = self._sink_saved
+        self._sink_saved = None
+        # Leave streams alone that the program replaced meanwhile
+        if isinstance(sys.stdout, _SinkStream):
+            sys.stdout = stdout
+        if isinstance(sys.stderr, _SinkStream):
+            sys.stderr = stderr
+        builtins.print = orig_print
+        logging.Handler.handle = orig_handle
+
+    def _sink_call(self, frame, func, args, kw, kind):
+        local = self._sink_local
+        if getattr(local, 'busy', False):
+            return func(*args, **kw)
+        local.busy = True
+        try:
+            output_filter = self.output_filter
+            if output_filter is not None and not output_filter.admit(
+                    kind, args[1:] if kind == 'record' else args, kw):
+                if self.stats is not None:
+                    self.stats.count('output calls filtered out')
+            elif not self._caller_ignored(frame):
+                self._log_round(frame)
+            return func(*args, **kw)
+        finally:
+            local.busy = False
 
+    def _caller_ignored(self, frame):
+        """Return true iff the code that asked for output is ignored.
 
-        return self.localtrace
+        That is the first frame that is neither the tracer's nor in the
+        logging/traceback modules, as in the printed round.
+        """
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if (filename != self.trace_regex
+                    and filename not in self.log_tb_file):
+                code = frame.f_code
+                try:
+                    return self._code_ignored[code]
+                except KeyError:
+                    pass
+                filename = frame.f_globals.get('__file__', None)
+                ignored = (not filename
+                           or self.ignore.names(filename, _modname(filename)))
+                self._code_ignored[code] = ignored
+                return ignored
+            frame = frame.f_back
+        return True
+
+    def profile_c_calls(self, frame, why, arg):
+        """Profile-hook backend of the log-trace mode.
+
+        Prints a round for every call of builtin print() and of the
+        write()/writelines() methods of io objects, made from frame.
+        Only calls are reported, so there are no line events and no
+        source is read.  print() is recognised by identity, so plain
+        aliases such as p = print are found too.  A functools.partial
+        of print() is called from C without a c_call event, so its
+        calls are not seen.
+        """
+        if why == 'c_call':
+            if arg is _builtin_print:
+                pass
+            elif (arg.__name__ not in _OUTPUT_METHODS
+                  or not isinstance(getattr(arg, '__self__', None), io.IOBase)):
+                return
+            if not self._caller_ignored(frame):
+                self._log_round(frame)
 
     def localtrace_count(self, frame, why, arg):
+        # Like the local tracers of _line_tracer(), one call at a time
         if why == "line":
-            filename = frame.f_code.co_filename
-            lineno = frame.f_lineno
-            key = filename, lineno
-            self.counts[key] = self.counts.get(key, 0) + 1
+            self._count_code_line(frame)
         return self.localtrace
 
     def results(self):
-        return CoverageResults(self.counts, infile=self.infile,
+        counts = dict(self.counts)
+        for code, (base, lines) in self._line_counts.items():
+            filename = code.co_filename
+            for index, n in enumerate(lines):
+                if n:
+                    key = filename, base + index
+                    counts[key] = counts.get(key, 0) + n
+        if self.first_hit:
+            # A line shared by several code objects, e.g. a class
+            # statement, still ran, which shows as 1
+            counts = dict.fromkeys(counts, 1)
+        return CoverageResults(counts, infile=self.infile,
                                outfile=self.outfile,
                                calledfuncs=self._calledfuncs,
                                callers=self._callers)
 
+def _parse_site_budget(spec):
+    """Parse FILE:LINE=cap=N,sample=N,rate=R into {(FILE, LINE): limits}."""
+    site, sep, limits = spec.partition('=')
+    filename, sep2, lineno = site.rpartition(':')
+    if not sep or not sep2 or not filename:
+        raise ValueError('expected FILE:LINE=SPEC')
+    override = {}
+    for item in limits.split(','):
+        name, sep, value = item.partition('=')
+        if name in ('cap', 'sample'):
+            override[name] = int(value)
+        elif name == 'rate':
+            override[name] = float(value)
+        else:
+            raise ValueError('unknown limit %r' % name)
+    if override.get('sample', 1) < 1:
+        raise ValueError('sample must be >= 1')
+    return {(filename, int(lineno)): override}
+
 def main():
     import argparse
 
@@ -927,6 +3344,12 @@ def main():
                  '--no-report below.')
     grp.add_argument('-t', '--trace', action='store_true',
             help='Print each line to sys.stdout before it is executed')
+    grp.add_argument('-P', '--trace-calls', action='store_true',
+            help='Like --trace, but use a profile hook that only looks at '
+                 'calls of builtin print() and of the write methods of io '
+                 'objects. No line is traced, and plain aliases of print() '
+                 '(p = print) are found too, but not functools.partial '
+                 'wrappers of it. Same as --trace --backend profile')
     grp.add_argument('-l', '--listfuncs', action='store_true',
             help='Keep track of which functions are executed at least once '
                  'and write the results to sys.stdout after the program exits. '
@@ -934,6 +3357,14 @@ def main():
     grp.add_argument('-T', '--trackcalls', action='store_true',
             help='Keep track of caller/called pairs and write the results to '
                  'sys.stdout after the program exits.')
+    grp.add_argument('--callgraph', metavar='FILE',
+            help='Write a call graph with the number of calls and the '
+                 'inclusive and exclusive time of each caller -> callee '
+                 'edge to FILE, see --callgraph-format')
+    grp.add_argument('--replay', metavar='FILE',
+            help='Print the rounds recorded with --record FILE; does not '
+                 'execute any code. See also --replay-filter, '
+                 '--replay-thread and --timing')
 
     grp = parser.add_argument_group('Modifiers')
 
@@ -948,7 +3379,9 @@ def main():
                  'Useful if you want to accumulate over several runs.')
 
     grp.add_argument('-f', '--file',
-            help='File to accumulate counts over several runs')
+            help='File to accumulate counts over several runs. Runs may '
+                 'add to it at the same time; counts files of older '
+                 'versions are read and converted')
     grp.add_argument('-C', '--coverdir',
             help='Directory where the report files go. The coverage report '
                  'for <package>.<module> will be written to file '
@@ -959,19 +3392,127 @@ def main():
     grp.add_argument('-s', '--summary', action='store_true',
             help='Write a brief summary for each file to sys.stdout. '
                  'Can only be used with --count or --report')
+    grp.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+            help='Write the .cover files with N processes; 0 for one per '
+                 'CPU. Default: 1')
+    grp.add_argument('--cache-dir', metavar='DIR',
+            help='Keep the executable lines of each source file in DIR '
+                 'between reports, so that unchanged files are not parsed '
+                 'again for --missing')
+    grp.add_argument('--first-hit', action='store_true',
+            help='With --count, only record whether each line ran and stop '
+                 'tracing a line once it has. The annotated listings show '
+                 'a count of 1 for the lines that ran')
+    grp.add_argument('--callgraph-format', choices=['collapsed', 'callgrind'],
+            default='collapsed',
+            help='Format of --callgraph: "collapsed" stacks with their '
+                 'exclusive time in microseconds, written as the program '
+                 'runs, for flame graph tools (default), or "callgrind" '
+                 'for KCachegrind and similar viewers')
+    grp.add_argument('--stats', action='store_true',
+                     help='Count and time the tracer\'s own work (call and '
+                     'line events, ignore checks, stack walks, diffing, '
+                     'rendering) and print it on stderr at the end')
+    grp.add_argument('--stats-json', metavar='FILE',
+                     help='Like --stats, but write the numbers to FILE as '
+                     'JSON')
     grp.add_argument('-g', '--timing', action='store_true',
             help='Prefix each line with the time since the program started. '
                  'Only used while tracing')
+    grp.add_argument('--record', metavar='FILE',
+            help='With --trace, append each round to FILE in a compact '
+                 'binary form instead of printing it. Use --replay FILE '
+                 'to print them')
+    grp.add_argument('--replay-filter', metavar='REGEX',
+            help='With --replay, only print rounds with a frame whose '
+                 'filename or source line matches REGEX')
+    grp.add_argument('--replay-thread', metavar='TID', type=int,
+            help='With --replay, only print rounds of the given thread '
+                 'number, as shown in the "thread N" tags')
+    grp.add_argument('--follow-children', action='store_true',
+            help='With --record FILE, also trace forked children and the '
+                 'Python processes the program starts (subprocess, '
+                 'multiprocessing); each records to FILE.<pid>. Children '
+                 'started with -E or -I are not traced')
+    grp.add_argument('--merge', action='store_true',
+            help='With --replay FILE, also read the FILE.<pid> recordings '
+                 'of --follow-children and print all rounds in time order, '
+                 'tagged with their pid')
+    grp.add_argument('--render-queue', metavar='N', type=int, default=0,
+            help='With --trace, format and print rounds on a background '
+                 'thread that takes them from a queue of N rounds, instead '
+                 'of on the traced thread. The program\'s own output may '
+                 'then get ahead of the rounds. Default: 0, print at once')
+    grp.add_argument('--render-policy', choices=['block', 'drop'],
+            default='block',
+            help='What to do with a round when the --render-queue is full: '
+                 'wait for room (default), or drop it and report how many '
+                 'were dropped at exit')
+    grp.add_argument('--history', metavar='N', type=int, default=0,
+            help='With --trace or --replay, number the rounds and remember '
+                 'the last N distinct stacks. A round then refers to the '
+                 'earlier round it shares its outer frames with ("== Round '
+                 '#k") instead of printing them again. Default: 0, compare '
+                 'with the previous round only')
+    grp.add_argument('--asyncio', action='store_true',
+            help='With --trace, show the output of an asyncio task with '
+                 'the await chain of the tasks waiting for it instead of '
+                 'the event loop frames, tag it with the task name and '
+                 'compare it with the earlier rounds of the same task only')
+    grp.add_argument('--max-rounds', metavar='N', type=int, default=0,
+            help='With --trace, print at most N rounds per output call '
+                 'site (file:line). Default: 0, no limit')
+    grp.add_argument('--sample', metavar='N', type=int, default=1,
+            help='With --trace, print a round for only every N-th call '
+                 'of each output call site')
+    grp.add_argument('--site-rate', metavar='R', type=float, default=0,
+            help='With --trace, print at most R rounds per second per '
+                 'output call site (token bucket). Default: 0, no limit')
+    grp.add_argument('--rate', metavar='R', type=float, default=0,
+            help='With --trace, print at most R rounds per second in all '
+                 '(token bucket). Default: 0, no limit')
+    grp.add_argument('--site-budget', metavar='FILE:LINE=SPEC',
+            action='append', default=[],
+            help='Budget of one output call site, overriding --max-rounds, '
+                 '--sample and --site-rate; SPEC is a comma separated list '
+                 'of cap=N, sample=N and rate=R, e.g. '
+                 'pkg/mod.py:42=cap=10,rate=0.5. Can be given several times. '
+                 'The rounds each site lost are listed at the end')
+    grp.add_argument('--backend',
+            choices=['auto', 'settrace', 'monitoring', 'sink', 'profile'],
+            default='auto',
+            help='Hooks used by --trace: sys.settrace, or sys.monitoring '
+                 '(Python 3.12+) which only pays for lines that may write '
+                 'output. "auto" picks sys.monitoring when available. '
+                 '"sink" traces no lines and wraps sys.stdout, sys.stderr, '
+                 'print() and logging handlers instead, so the cost is '
+                 'paid per output only. "profile" is what --trace-calls '
+                 'uses')
 
     grp = parser.add_argument_group('Filters',
             'Can be specified multiple times')
+    grp.add_argument('--output-match', metavar='REGEX',
+            help='Only make rounds for the output whose text matches REGEX '
+                 '(searched in the text of each print() or write() call, '
+                 'or in the message of a log record), e.g. "ERROR|Timeout". '
+                 'Implies --backend sink')
+    grp.add_argument('--logger', action='append', default=[],
+            help='Only make rounds for the records of this logger and its '
+                 'children; other output is dropped. Implies --backend sink')
+    grp.add_argument('--log-level', metavar='LEVEL',
+            help='Only make rounds for log records of at least LEVEL, a '
+                 'name such as WARNING or a number; other output is '
+                 'dropped. Implies --backend sink')
     grp.add_argument('--ignore-module', action='append', default=[],
             help='Ignore the given module(s) and its submodules '
                  '(if it is a package). Accepts comma separated list of '
-                 'module names.')
+                 'module names, which may be glob patterns such as '
+                 '"tests.*".')
     grp.add_argument('--ignore-dir', action='append', default=[],
             help='Ignore files in the given directory '
-                 '(multiple directories can be joined by os.pathsep).')
+                 '(multiple directories can be joined by os.pathsep). '
+                 'Glob patterns are accepted: "*" matches within one path '
+                 'component, "**" across several, e.g. "**/site-packages".')
 
     parser.add_argument('--module', action='store_true', default=False,
                         help='Trace a module. ')
@@ -996,15 +3537,39 @@ def main():
     opts.ignore_dir = [parse_ignore_dir(s)
                        for i in opts.ignore_dir for s in i.split(os.pathsep)]
 
+    if opts.replay:
+        try:
+            return replay_rounds(opts.replay, opts.timing,
+                                 opts.replay_filter, opts.replay_thread,
+                                 opts.history, opts.merge)
+        except (OSError, ValueError) as err:
+            sys.exit("Cannot replay %r because: %s" % (opts.replay, err))
+
+    if opts.jobs < 0:
+        parser.error('--jobs must not be negative')
+
     if opts.report:
         if not opts.file:
             parser.error('-r/--report requires -f/--file')
         results = CoverageResults(infile=opts.file, outfile=opts.file)
-        return results.write_results(opts.missing, opts.summary, opts.coverdir)
+        return results.write_results(opts.missing, opts.summary, opts.coverdir,
+                                     opts.jobs, opts.cache_dir)
 
-    if not any([opts.trace, opts.count, opts.listfuncs, opts.trackcalls]):
+    if opts.trace_calls:
+        if opts.backend not in ('auto', 'profile'):
+            parser.error('cannot specify both --trace-calls and --backend')
+        opts.trace = True
+        opts.backend = 'profile'
+
+    if not any([opts.trace, opts.count, opts.listfuncs, opts.trackcalls,
+                opts.callgraph]):
         parser.error('must specify one of --trace, --count, --report, '
-                     '--listfuncs, or --trackcalls')
+                     '--listfuncs, --trackcalls or --callgraph')
+
+    if opts.callgraph and any([opts.trace, opts.count, opts.listfuncs,
+                               opts.trackcalls]):
+        parser.error('--callgraph cannot be used with --trace, --count, '
+                     '--listfuncs or --trackcalls')
 
     if opts.listfuncs and (opts.count or opts.trace):
         parser.error('cannot specify both --listfuncs and (--trace or --count)')
@@ -1015,10 +3580,83 @@ def main():
     if opts.progname is None:
         parser.error('progname is missing: required with the main options')
 
+    if opts.backend == 'monitoring' and not _HAVE_MONITORING:
+        parser.error('--backend monitoring requires Python 3.12 or later')
+
+    if opts.record and not opts.trace:
+        parser.error('--record can only be used with --trace')
+
+    budget = None
+    if (opts.max_rounds or opts.sample != 1 or opts.site_rate or opts.rate
+            or opts.site_budget):
+        if not opts.trace:
+            parser.error('the budget options can only be used with --trace')
+        if opts.sample < 1:
+            parser.error('--sample must be at least 1')
+        sites = {}
+        for spec in opts.site_budget:
+            try:
+                sites.update(_parse_site_budget(spec))
+            except ValueError as err:
+                parser.error('bad --site-budget %r: %s' % (spec, err))
+        budget = SiteBudget(opts.max_rounds, opts.sample, opts.site_rate,
+                            opts.rate, sites)
+
+    output_filter = None
+    if opts.output_match or opts.logger or opts.log_level:
+        if not opts.trace or opts.count:
+            parser.error('--output-match, --logger and --log-level can '
+                         'only be used with --trace alone')
+        if opts.backend not in ('auto', 'sink'):
+            parser.error('--output-match, --logger and --log-level need '
+                         '--backend sink')
+        opts.backend = 'sink'
+        level = opts.log_level
+        if level is not None:
+            if level.isdigit():
+                level = int(level)
+            else:
+                level = logging.getLevelName(level.upper())
+                if not isinstance(level, int):
+                    parser.error('unknown log level %r' % opts.log_level)
+        try:
+            output_filter = OutputFilter(opts.output_match, opts.logger,
+                                         level)
+        except re.error as err:
+            parser.error('bad --output-match %r: %s' % (opts.output_match,
+                                                        err))
+
+    if opts.first_hit and (not opts.count or opts.trace):
+        parser.error('--first-hit can only be used with --count alone')
+
+    if opts.asyncio and not opts.trace:
+        parser.error('--asyncio can only be used with --trace')
+
+    if opts.follow_children and not opts.record:
+        parser.error('--follow-children requires --record')
+
+    if opts.backend in ('sink', 'profile') and (opts.count or not opts.trace):
+        parser.error('--backend %s can only be used with --trace alone'
+                     % opts.backend)
+
+    if (opts.backend == 'monitoring' and not opts.first_hit
+            and (opts.count or not opts.trace)):
+        parser.error('--backend monitoring can only be used with --trace '
+                     'alone or with --count --first-hit')
+
     t = Trace(opts.count, opts.trace, countfuncs=opts.listfuncs,
               countcallers=opts.trackcalls, ignoremods=opts.ignore_module,
               ignoredirs=opts.ignore_dir, infile=opts.file,
-              outfile=opts.file, timing=opts.timing)
+              outfile=opts.file, timing=opts.timing,
+              backend=None if opts.backend == 'auto' else opts.backend,
+              record=opts.record, render_queue=opts.render_queue,
+              render_policy=opts.render_policy, history=opts.history,
+              follow_children=opts.follow_children,
+              asyncio_tasks=opts.asyncio, budget=budget,
+              first_hit=opts.first_hit, callgraph=opts.callgraph,
+              callgraph_format=opts.callgraph_format,
+              stats=opts.stats or bool(opts.stats_json),
+              output_filter=output_filter)
     try:
         if opts.module:
             import runpy
@@ -1054,8 +3692,15 @@ def main():
 
     results = t.results()
 
+    start = _perf_counter()
     if not opts.no_report:
-        results.write_results(opts.missing, opts.summary, opts.coverdir)
+        results.write_results(opts.missing, opts.summary, opts.coverdir,
+                              opts.jobs, opts.cache_dir)
+    else:
+        results.save()
+    if t.stats is not None:
+        t.stats.add_time('write results', _perf_counter() - start)
+        t.stats.report(opts.stats_json)
 
 if __name__=='__main__':
     main()
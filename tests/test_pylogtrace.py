@@ -0,0 +1,699 @@
+"""Unit tests of the helper classes of pylogtrace.
+
+    $ python3 -m pytest tests
+    $ python3 -m unittest discover tests
+"""
+
+import contextlib
+import io
+import json
+import linecache
+import logging
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylogtrace
+from pylogtrace import (StackDiff, StackTrie, SiteBudget, OutputFilter,
+                        Trace, _CallGraph, _SourceLines, _CountsStore,
+                        _RoundRecorder, _find_output_linenos, _read_rounds)
+
+
+def split_calls(out):
+    print('a',
+          'b', file=out)
+    out.write(
+        'c\n')
+    print('d', file=out)
+    for i in range(2):
+        print('e',
+              i, file=out)
+
+
+def print_twice(out):
+    for _ in range(2):
+        print('x', file=out)
+
+
+def add_up(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def append_twice():
+    first, second = [], []
+    first.append(1)
+    second.append(2)
+    return len(first) + len(second)
+
+
+class FakeClock:
+    """Stands in for pylogtrace._time, moved on by hand."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StackDiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sd = StackDiff()
+
+    def test_first_stack(self):
+        self.assertIsNone(self.sd.diff(['a', 'b', 'c']))
+
+    def test_same_stack(self):
+        self.sd.diff(['a', 'b', 'c'])
+        self.assertEqual(self.sd.diff(['a', 'b', 'c']), (0, 0, 3))
+
+    def test_new_inner_frame(self):
+        self.sd.diff(['a', 'b', 'c'])
+        # frames[1:] == previous[1:]
+        self.assertEqual(self.sd.diff(['x', 'b', 'c']), (1, 1, 3))
+
+    def test_deeper_stack(self):
+        self.sd.diff(['a', 'b'])
+        self.assertEqual(self.sd.diff(['y', 'x', 'a', 'b']), (2, 0, 2))
+
+    def test_shallower_stack(self):
+        self.sd.diff(['y', 'x', 'a', 'b'])
+        self.assertEqual(self.sd.diff(['a', 'b']), (0, 2, 4))
+
+    def test_no_common_frames(self):
+        self.sd.diff(['a', 'b'])
+        self.assertIsNone(self.sd.diff(['c', 'd']))
+
+    def test_empty_stacks(self):
+        self.assertIsNone(self.sd.diff([]))
+        self.assertIsNone(self.sd.diff(['a']))
+        self.assertIsNone(self.sd.diff([]))
+
+    def test_repeated_frames(self):
+        # Recursion: the smallest curr_at wins, then the smallest prev_at
+        self.sd.diff(['f', 'f', 'main'])
+        self.assertEqual(self.sd.diff(['f', 'f', 'f', 'main']), (1, 0, 3))
+
+    def test_compares_with_previous_stack_only(self):
+        self.sd.diff(['a', 'b'])
+        self.sd.diff(['c', 'd'])
+        self.assertIsNone(self.sd.diff(['a', 'b']))
+
+    def test_matches_brute_force(self):
+        def brute(prev, curr):
+            for i in range(len(curr)):
+                for j in range(len(prev)):
+                    tail = prev[j:]
+                    if curr[i:i + len(tail)] == tail:
+                        return i, j, len(prev)
+            return None
+
+        stacks = [[], ['a'], ['a', 'b'], ['b', 'a'], ['a', 'a', 'b'],
+                  ['c', 'a', 'b'], ['a', 'b', 'a', 'b'], ['b', 'b', 'b'],
+                  ['c', 'b', 'a', 'b', 'c']]
+        for prev in stacks:
+            for curr in stacks:
+                sd = StackDiff()
+                sd.diff(prev)
+                self.assertEqual(sd.diff(curr), brute(prev, curr),
+                                 (prev, curr))
+
+    def test_intern(self):
+        self.assertEqual(self.sd.intern(('f.py', 1)), 0)
+        self.assertEqual(self.sd.intern(('f.py', 2)), 1)
+        self.assertEqual(self.sd.intern(('f.py', 1)), 0)
+
+
+class StackTrieTest(unittest.TestCase):
+
+    def test_first_round(self):
+        trie = StackTrie()
+        rnd, _, ref_round, ref_frames, shared = trie.add(['a', 'b'])
+        self.assertEqual((rnd, ref_round, ref_frames, shared),
+                         (1, None, None, 0))
+
+    def test_shared_outer_frames(self):
+        trie = StackTrie()
+        first = trie.add(['a', 'b'])
+        second = trie.add(['c', 'b'])
+        self.assertEqual(second[0], 2)
+        self.assertNotEqual(second[1], first[1])
+        self.assertEqual(second[2:], (1, 2, 1))
+
+    def test_same_stack_keeps_its_id(self):
+        trie = StackTrie()
+        first = trie.add(['a', 'b'])
+        trie.add(['c', 'b'])
+        third = trie.add(['a', 'b'])
+        self.assertEqual(third, (3, first[1], 1, 2, 2))
+
+    def test_most_shared_frames_win(self):
+        trie = StackTrie()
+        trie.add(['x', 'a', 'main'])
+        trie.add(['b', 'main'])
+        # Round 2 is newer, but round 1 shares two frames
+        self.assertEqual(trie.add(['y', 'a', 'main'])[2:], (1, 3, 2))
+
+    def test_forgotten_stack(self):
+        trie = StackTrie(history=1)
+        first = trie.add(['a'])
+        trie.add(['b'])
+        self.assertEqual(trie.add(['a']), (3, first[1], None, None, 0))
+
+    def test_use_keeps_stack_in_history(self):
+        trie = StackTrie(history=2)
+        trie.add(['a', 'main'])
+        trie.add(['b', 'main'])
+        trie.add(['a', 'main'])     # refers to round 1
+        trie.add(['c', 'main'])     # pushes out the stack of round 2
+        self.assertEqual(trie.add(['a', 'main'])[2:], (3, 2, 2))
+        self.assertEqual(trie.add(['b', 'main'])[2:], (5, 2, 1))
+
+    def test_prune(self):
+        trie = StackTrie(history=1)
+        for i in range(1000):
+            trie.add([i, 'main'])
+        self.assertLessEqual(len(trie._last), 64 * trie.history + 2)
+        self.assertLessEqual(len(trie._children), 64 * trie.history + 2)
+        # The remembered stack still matches after pruning
+        self.assertEqual(trie.add([999, 'main'])[2:], (1000, 2, 2))
+
+
+class SiteBudgetTest(unittest.TestCase):
+
+    site = ('/src/app.py', 10)
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(pylogtrace, '_time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def admits(self, budget, n, site=site):
+        return [budget.admit(site) for _ in range(n)]
+
+    def test_unlimited(self):
+        budget = SiteBudget()
+        self.assertEqual(self.admits(budget, 5), [True] * 5)
+        self.assertEqual(budget.suppressed(), [])
+
+    def test_cap(self):
+        budget = SiteBudget(cap=2)
+        self.assertEqual(self.admits(budget, 4), [True, True, False, False])
+        self.assertEqual(budget.suppressed(), [(self.site, 2, 4)])
+
+    def test_sample(self):
+        budget = SiteBudget(sample=3)
+        self.assertEqual(self.admits(budget, 7),
+                         [True, False, False, True, False, False, True])
+
+    def test_bad_sample(self):
+        with self.assertRaises(ValueError):
+            SiteBudget(sample=0)
+
+    def test_rate(self):
+        budget = SiteBudget(rate=2)
+        self.assertEqual(self.admits(budget, 3), [True, True, False])
+        self.clock.now += 0.5
+        self.assertEqual(self.admits(budget, 2), [True, False])
+        # The bucket holds no more than max(rate, 1) tokens
+        self.clock.now += 100
+        self.assertEqual(self.admits(budget, 3), [True, True, False])
+
+    def test_slow_rate(self):
+        budget = SiteBudget(rate=0.5)
+        self.assertEqual(self.admits(budget, 2), [True, False])
+        self.clock.now += 1
+        self.assertEqual(self.admits(budget, 1), [False])
+        self.clock.now += 1
+        self.assertEqual(self.admits(budget, 1), [True])
+
+    def test_global_rate(self):
+        budget = SiteBudget(rate=5, global_rate=1)
+        other = ('/src/app.py', 20)
+        self.assertTrue(budget.admit(self.site))
+        self.assertFalse(budget.admit(other))
+        self.clock.now += 1
+        # The site's token came back when the global bucket said no
+        self.assertTrue(budget.admit(other))
+
+    def test_site_override(self):
+        budget = SiteBudget(sites={(os.path.join('src', 'app.py'), 10):
+                                   {'cap': 1}})
+        self.assertEqual(self.admits(budget, 2), [True, False])
+        self.assertEqual(self.admits(budget, 2, ('/src/app.py', 11)),
+                         [True, True])
+        self.assertEqual(self.admits(budget, 2, ('/xsrc/app.py', 10)),
+                         [True, True])
+
+    def test_suppressed_order(self):
+        budget = SiteBudget(cap=1)
+        other = ('/src/app.py', 20)
+        self.admits(budget, 2)
+        self.admits(budget, 4, other)
+        self.assertEqual(budget.suppressed(),
+                         [(other, 3, 4), (self.site, 1, 2)])
+
+    def test_summary_per_stop(self):
+        tracer = Trace(count=0, trace=1, backend='sink',
+                       budget=SiteBudget(cap=1))
+        out = io.StringIO()
+        summaries = []
+        for _ in range(3):
+            err = io.StringIO()
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(err):
+                tracer.start()
+                try:
+                    print_twice(out)
+                finally:
+                    tracer.stop()
+            summaries.append(err.getvalue().splitlines()[1:])
+        line = print_twice.__code__.co_firstlineno + 2
+        site = '  %s:%d: ' % (__file__, line)
+        # The same site lost rounds in each run, so it is listed each
+        # time, with the counts so far
+        self.assertEqual(summaries, [[site + '1 of 2'], [site + '3 of 4'],
+                                     [site + '5 of 6']])
+        # Nothing new was lost
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            tracer.start()
+            tracer.stop()
+        self.assertEqual(err.getvalue(), '')
+
+    def test_config(self):
+        budget = SiteBudget(cap=3, sample=2, rate=1.5, global_rate=10,
+                            sites={('pkg/mod.py', 7): {'cap': 1}})
+        config = json.loads(json.dumps(budget.config()))
+        copy = SiteBudget.from_config(config)
+        self.assertEqual(copy.config(), budget.config())
+        self.assertEqual(copy.sites, budget.sites)
+
+
+class OutputFilterTest(unittest.TestCase):
+
+    def record(self, name='app', level=logging.INFO, msg='hello', args=()):
+        return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+    def test_no_filter(self):
+        output_filter = OutputFilter()
+        self.assertTrue(output_filter.admit('print', ('x',), {}))
+        self.assertTrue(output_filter.admit('write', ('x',), {}))
+        self.assertTrue(output_filter.admit('record', (self.record(),), {}))
+
+    def test_pattern_print(self):
+        output_filter = OutputFilter(pattern='err')
+        self.assertTrue(output_filter.admit('print', ('an', 'error'), {}))
+        self.assertFalse(output_filter.admit('print', ('ok',), {}))
+        self.assertTrue(output_filter.admit('print', ('e', 'rr'),
+                                            {'sep': ''}))
+        self.assertFalse(output_filter.admit('print', ('e', 'rr'), {}))
+        self.assertTrue(output_filter.admit('print', (1, 2),
+                                            {'sep': None, 'end': 'err'}))
+
+    def test_pattern_anchors(self):
+        output_filter = OutputFilter(pattern=r'done\n$')
+        self.assertTrue(output_filter.admit('print', ('done',), {}))
+        self.assertFalse(output_filter.admit('print', ('done',),
+                                             {'end': ''}))
+
+    def test_pattern_write(self):
+        output_filter = OutputFilter(pattern='err')
+        self.assertTrue(output_filter.admit('write', ('error\n',), {}))
+        self.assertFalse(output_filter.admit('write', ('ok\n',), {}))
+        self.assertTrue(output_filter.admit('writelines', (['e', 'rr'],),
+                                            {}))
+        self.assertTrue(output_filter.admit('write', (b'error',), {}))
+
+    def test_pattern_record(self):
+        output_filter = OutputFilter(pattern='code 42')
+        self.assertTrue(output_filter.admit(
+            'record', (self.record(msg='code %d', args=(42,)),), {}))
+        self.assertFalse(output_filter.admit(
+            'record', (self.record(msg='code %d', args=(7,)),), {}))
+
+    def test_bad_record_args(self):
+        output_filter = OutputFilter(pattern='code')
+        record = self.record(msg='code %d', args=('x',))
+        self.assertTrue(output_filter.admit('record', (record,), {}))
+
+    def test_loggers(self):
+        output_filter = OutputFilter(loggers=['app'])
+        self.assertFalse(output_filter.admit('print', ('x',), {}))
+        self.assertFalse(output_filter.admit('write', ('x',), {}))
+        for name, admitted in [('app', True), ('app.db', True),
+                               ('apple', False), ('other.app', False)]:
+            self.assertEqual(output_filter.admit(
+                'record', (self.record(name=name),), {}), admitted, name)
+
+    def test_level(self):
+        output_filter = OutputFilter(level=logging.WARNING)
+        self.assertFalse(output_filter.admit('print', ('x',), {}))
+        self.assertFalse(output_filter.admit(
+            'record', (self.record(level=logging.INFO),), {}))
+        self.assertTrue(output_filter.admit(
+            'record', (self.record(level=logging.WARNING),), {}))
+
+    def test_all_conditions(self):
+        output_filter = OutputFilter(pattern='disk', loggers=['app'],
+                                     level=logging.ERROR)
+        self.assertTrue(output_filter.admit('record', (self.record(
+            'app.io', logging.ERROR, 'disk full'),), {}))
+        self.assertFalse(output_filter.admit('record', (self.record(
+            'app.io', logging.ERROR, 'net down'),), {}))
+        self.assertFalse(output_filter.admit('record', (self.record(
+            'app.io', logging.INFO, 'disk full'),), {}))
+        self.assertFalse(output_filter.admit('record', (self.record(
+            'lib', logging.ERROR, 'disk full'),), {}))
+
+    def test_config(self):
+        output_filter = OutputFilter(pattern='x+', loggers=['a', 'b.c'],
+                                     level=logging.INFO)
+        config = json.loads(json.dumps(output_filter.config()))
+        self.assertEqual(OutputFilter.from_config(config).config(),
+                         output_filter.config())
+
+
+class SourceLinesTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.lines = _SourceLines()
+        self.addCleanup(self.close_maps)
+
+    def close_maps(self):
+        for data in self.lines._maps.values():
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def assertSameAsLinecache(self, path):
+        linecache.checkcache(path)
+        expected = linecache.getlines(path)
+        self.assertEqual(self.lines.getlines(path), expected)
+        for lineno in range(len(expected) + 2):
+            self.assertEqual(self.lines.getline(path, lineno),
+                             linecache.getline(path, lineno), lineno)
+
+    def test_lines(self):
+        path = self.write('m.py', b'a = 1\n\nb = "\xc3\xa9"\n')
+        self.assertSameAsLinecache(path)
+        self.assertEqual(self.lines.getline(path, 3), 'b = "\xe9"\n')
+        self.assertEqual(self.lines.encoding(path), 'utf-8')
+
+    def test_crlf_and_no_final_newline(self):
+        path = self.write('m.py', b'a = 1\r\nb = 2\r\nc = 3')
+        self.assertSameAsLinecache(path)
+        self.assertEqual(self.lines.getline(path, 3), 'c = 3\n')
+
+    def test_coding_cookie(self):
+        path = self.write('m.py',
+                          b'# -*- coding: latin-1 -*-\ns = "\xe9"\n')
+        self.assertSameAsLinecache(path)
+        self.assertEqual(self.lines.getline(path, 2), 's = "\xe9"\n')
+        self.assertEqual(self.lines.encoding(path), 'iso-8859-1')
+
+    def test_empty_file(self):
+        path = self.write('m.py', b'')
+        self.assertEqual(self.lines.getlines(path), [])
+        self.assertEqual(self.lines.getline(path, 1), '')
+
+    def test_lone_cr_left_to_linecache(self):
+        path = self.write('m.py', b'a = 1\rb = 2\n')
+        self.assertIsNone(self.lines.encoding(path))
+        self.assertSameAsLinecache(path)
+
+    def test_missing_file(self):
+        path = os.path.join(self.dir, 'missing.py')
+        self.assertEqual(self.lines.getline(path, 1), '')
+        self.assertEqual(self.lines.getlines(path), [])
+        self.assertIsNone(self.lines.encoding(path))
+
+    def test_checkcache(self):
+        path = self.write('m.py', b'a = 1\n')
+        self.assertEqual(self.lines.getline(path, 1), 'a = 1\n')
+        self.write('m.py', b'bb = 22\ncc = 33\n')
+        self.lines.checkcache()
+        self.assertEqual(self.lines.getline(path, 2), 'cc = 33\n')
+
+    def test_changed_file_is_indexed_again_on_remap(self):
+        self.lines.max_maps = 1
+        path = self.write('m.py', b'a = 1\n')
+        other = self.write('o.py', b'o = 1\n')
+        self.assertEqual(self.lines.getline(path, 1), 'a = 1\n')
+        self.assertEqual(self.lines.getline(other, 1), 'o = 1\n')
+        self.write('m.py', b'bb = 22\ncc = 33\n')
+        self.assertEqual(self.lines.getline(path, 2), 'cc = 33\n')
+        self.assertEqual(self.lines.getlines(path),
+                         ['bb = 22\n', 'cc = 33\n'])
+
+    def test_max_maps(self):
+        self.lines.max_maps = 2
+        paths = [self.write('m%d.py' % i, b'x = %d\ny = 0\n' % i)
+                 for i in range(5)]
+        for _ in range(2):
+            for i, path in enumerate(paths):
+                self.assertEqual(self.lines.getline(path, 1), 'x = %d\n' % i)
+                self.assertLessEqual(len(self.lines._maps), 2)
+
+    def test_lookup_from_trace_function(self):
+        # Indexing runs re and tokenize; a tracer that looks up lines in
+        # them, as pylogtrace does, must not deadlock.
+        path = self.write('m.py', b'a = 1\n')
+        other = self.write('o.py', b'o = 1\n')
+        seen = []
+        busy = []
+
+        def tracer(frame, why, arg):
+            if why == 'call' and not busy:
+                busy.append(1)
+                try:
+                    seen.append(self.lines.getline(other, 1))
+                finally:
+                    busy.pop()
+            return None
+
+        def run():
+            sys.settrace(tracer)
+            try:
+                seen.append(self.lines.getline(path, 1))
+            finally:
+                sys.settrace(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), 'getline() deadlocked')
+        self.assertEqual(seen[-1], 'a = 1\n')
+        self.assertIn('o = 1\n', seen)
+
+
+class CountsStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'counts')
+
+    def store(self, path=None):
+        store = _CountsStore(path or self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def test_file_format(self):
+        self.assertEqual(_CountsStore.file_format(self.path), 'empty')
+        open(self.path, 'wb').close()
+        self.assertEqual(_CountsStore.file_format(self.path), 'empty')
+        with open(self.path, 'wb') as f:
+            pickle.dump(({}, {}, {}), f, 1)
+        self.assertEqual(_CountsStore.file_format(self.path), 'other')
+        os.remove(self.path)
+        self.store().close()
+        self.assertEqual(_CountsStore.file_format(self.path), 'store')
+
+    def test_add(self):
+        store = self.store()
+        store.add({('a.py', 1): 2, ('a.py', 3): 1, ('b.py', 5): 7,
+                   ('c.py', None): 1},
+                  {('a.py', 'a', 'f'): 1},
+                  {(('a.py', 'a', 'f'), ('b.py', 'b', 'g')): 1})
+        store.add({('a.py', 1): 3}, {('a.py', 'a', 'f'): 1}, {})
+        self.assertEqual(sorted(store.filenames()), ['a.py', 'b.py'])
+        self.assertEqual(store.file_counts('a.py'), {1: 5, 3: 1})
+        self.assertEqual(store.file_counts('b.py'), {5: 7})
+        self.assertEqual(store.file_counts('c.py'), {})
+        self.assertEqual(store.calledfuncs(), {('a.py', 'a', 'f'): 1})
+        self.assertEqual(store.callers(),
+                         {(('a.py', 'a', 'f'), ('b.py', 'b', 'g')): 1})
+
+    def test_two_connections(self):
+        first = self.store()
+        second = self.store()
+        first.add({('a.py', 1): 1}, {}, {})
+        second.add({('a.py', 1): 2, ('a.py', 2): 1}, {}, {})
+        self.assertEqual(first.file_counts('a.py'), {1: 3, 2: 1})
+
+    def test_merge(self):
+        other = self.store(self.path + '.other')
+        other.add({('a.py', 1): 4, ('b.py', 2): 1}, {('b.py', 'b', 'g'): 1},
+                  {})
+        store = self.store()
+        store.add({('a.py', 1): 1}, {}, {}, merge=other.path)
+        self.assertEqual(store.file_counts('a.py'), {1: 5})
+        self.assertEqual(store.file_counts('b.py'), {2: 1})
+        self.assertEqual(store.calledfuncs(), {('b.py', 'b', 'g'): 1})
+
+    def test_failed_add_is_rolled_back(self):
+        store = self.store()
+        store.add({('a.py', 1): 1}, {}, {})
+        with self.assertRaises(TypeError):
+            # The counts are added before the bad key is dumped
+            store.add({('a.py', 1): 1}, {object(): 1}, {})
+        self.assertEqual(store.file_counts('a.py'), {1: 1})
+        store.add({('a.py', 1): 1}, {}, {})
+        self.assertEqual(store.file_counts('a.py'), {1: 2})
+
+
+class RoundRecorderTest(unittest.TestCase):
+
+    def test_thread_numbers(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'rounds')
+        recorder = _RoundRecorder(path)
+        self.addCleanup(recorder._file.close)
+        recorder.record([('a.py', 1)], set())
+        for lineno in range(2, 5):
+            # Threads that run one after the other often get the same
+            # ident from the OS
+            thread = threading.Thread(target=recorder.record,
+                                      args=([('a.py', lineno)], set()))
+            thread.start()
+            thread.join()
+        recorder.record([('a.py', 5)], set())
+        recorder.flush()
+        self.assertEqual(
+            [(tid, frames) for _, _, _, tid, frames, _
+             in _read_rounds(path, {})],
+            [(1, [('a.py', 1)]), (2, [('a.py', 2)]), (3, [('a.py', 3)]),
+             (4, [('a.py', 4)]), (1, [('a.py', 5)])])
+
+
+class FollowChildrenTest(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork()')
+    def test_child_recordings(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'rounds')
+        tracer = Trace(count=0, trace=1, backend='sink', record=path,
+                       follow_children=True)
+        self.addCleanup(tracer._recorder._file.close)
+
+        def fork():
+            pid = os.fork()
+            if not pid:
+                os._exit(0)
+            os.waitpid(pid, 0)
+            return pid
+
+        tracer.start()
+        try:
+            traced = fork()
+        finally:
+            tracer.stop()
+        fork()
+        self.assertEqual(sorted(os.listdir(tmp.name)),
+                         ['rounds', 'rounds.%d' % traced])
+
+
+class LocalTraceTest(unittest.TestCase):
+
+    def test_localtrace_count(self):
+        # As trace.py callers use it: sys.settrace() with the tracer's
+        # local trace function
+        tracer = Trace(count=1, trace=0)
+        localtrace = tracer.localtrace_count
+        self.assertEqual(tracer.localtrace, localtrace)
+        sys.settrace(lambda frame, why, arg: localtrace
+                     if frame.f_code is add_up.__code__ else None)
+        try:
+            add_up(3)
+        finally:
+            sys.settrace(None)
+        first = add_up.__code__.co_firstlineno
+        self.assertEqual({lineno - first: n for (filename, lineno), n
+                          in tracer.results().counts.items()
+                          if filename == __file__},
+                         {1: 1, 2: 4, 3: 3, 4: 1})
+
+
+class CallGraphTest(unittest.TestCase):
+
+    def test_c_calls_keyed_by_function(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'callgraph')
+        graph = _CallGraph(path, 'collapsed',
+                           lambda frame: (None, None, frame.f_code.co_name),
+                           pylogtrace.__file__)
+        sys.setprofile(graph.profile)
+        try:
+            append_twice()
+        finally:
+            sys.setprofile(None)
+        graph.close()
+        edges = {(caller if caller is None else graph._labels[caller][2],
+                  graph._labels[callee][2]): n
+                 for (caller, callee), (n, _, _) in graph._edges.items()}
+        self.assertEqual(edges[('append_twice', 'list.append')], 2)
+        self.assertEqual(edges[('append_twice', 'builtins.len')], 2)
+
+
+class OutputSitesTest(unittest.TestCase):
+
+    def test_find_output_linenos(self):
+        first = split_calls.__code__.co_firstlineno
+        self.assertEqual(_find_output_linenos(__file__).get(first + 1),
+                         first + 2)
+        self.assertEqual(_find_output_linenos(__file__).get(first + 5),
+                         first + 5)
+
+    def round_lines(self, backend):
+        tracer = Trace(count=0, trace=1, backend=backend)
+        linenos = []
+        with mock.patch.object(tracer, '_log_round',
+                               lambda frame: linenos.append(frame.f_lineno)):
+            tracer.runfunc(split_calls, io.StringIO())
+        first = split_calls.__code__.co_firstlineno
+        return [lineno - first for lineno in linenos]
+
+    def test_split_call_makes_one_round(self):
+        self.assertEqual(self.round_lines('settrace'), [1, 3, 5, 7, 7])
+
+    @unittest.skipUnless(pylogtrace._HAVE_MONITORING, 'needs Python 3.12+')
+    def test_split_call_makes_one_round_monitoring(self):
+        self.assertEqual(self.round_lines('monitoring'), [1, 3, 5, 7, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()